@@ -13,10 +13,13 @@ from randomtools.scriptparser import Parser
 
 from collections import Counter, defaultdict
 from datetime import datetime
-from functools import lru_cache, total_ordering
+from functools import total_ordering
+from heapq import merge
 from io import BytesIO
 from itertools import product
+from multiprocessing import Pool
 from os import path, mkdir, environ
+from struct import Struct
 from time import time, gmtime
 from traceback import format_exc
 
@@ -76,6 +79,14 @@ def pretty_hexify(s, newlines=True):
         return ' '.join(result)
 
 
+def to_signed16(value):
+    return (value - 0x10000) if value & 0x8000 else value
+
+
+def squared_distance(a, b):
+    return sum((i - j) ** 2 for (i, j) in zip(a, b))
+
+
 def infer_lang_name(filename):
     if get_global_label() == 'MN64_JP':
         return filename
@@ -120,6 +131,58 @@ def patch_file(filename, file_index, parameters=None):
         f.close()
 
 
+class SubstringIndex:
+    '''
+    Suffix automaton over a byte string that only grows at the end. A search
+    takes time in the length of the searched string, not of the text, and
+    finds the same leftmost offset as bytes.find.
+    '''
+    def __init__(self):
+        self.transitions = [{}]
+        self.links = [-1]
+        self.lengths = [0]
+        self.first_ends = [-1]
+        self.last = 0
+
+    def new_state(self, transitions, link, length, first_end):
+        self.transitions.append(transitions)
+        self.links.append(link)
+        self.lengths.append(length)
+        self.first_ends.append(first_end)
+        return len(self.lengths) - 1
+
+    def extend(self, data):
+        for c in data:
+            length = self.lengths[self.last] + 1
+            current = self.new_state({}, 0, length, length - 1)
+            p = self.last
+            while p >= 0 and c not in self.transitions[p]:
+                self.transitions[p][c] = current
+                p = self.links[p]
+            if p >= 0:
+                q = self.transitions[p][c]
+                if self.lengths[p] + 1 == self.lengths[q]:
+                    self.links[current] = q
+                else:
+                    clone = self.new_state(
+                        dict(self.transitions[q]), self.links[q],
+                        self.lengths[p] + 1, self.first_ends[q])
+                    while p >= 0 and self.transitions[p].get(c) == q:
+                        self.transitions[p][c] = clone
+                        p = self.links[p]
+                    self.links[q] = clone
+                    self.links[current] = clone
+            self.last = current
+
+    def find(self, data):
+        state = 0
+        for c in data:
+            state = self.transitions[state].get(c)
+            if state is None:
+                return -1
+        return self.first_ends[state] - len(data) + 1
+
+
 class GoemonParser(Parser):
     def __eq__(self, other):
         if self is not other:
@@ -137,30 +200,64 @@ class GoemonParser(Parser):
         return self.decode(pointer.pointer, self.data)
 
     def dump_all_text(self):
-        encoded_strs = []
+        counts = {}
         for _, s in sorted(self.scripts.items()):
             for i in s.instructions:
                 for parameter_name in i.text_parameters:
                     encoded = self.encode(i.text_parameters[parameter_name])
-                    encoded_strs.append(encoded)
-        encoded_strs = sorted(encoded_strs, key=lambda s: (-len(s), s))
-        most = max(encoded_strs, key=lambda s: (encoded_strs.count(s),
-                                                -encoded_strs.index(s)))
-        encoded_strs = [most] + encoded_strs
-        bytecode = b''
-        for s in encoded_strs:
-            if s in bytecode:
+                    counts[encoded] = counts.get(encoded, 0) + 1
+        encoded_strs = sorted(counts, key=lambda s: (-len(s), s))
+        if not encoded_strs:
+            self.text_dump = b''
+            self.text_offsets = {}
+            return self.text_dump
+        most = max(encoded_strs, key=lambda s: counts[s])
+
+        # Strings that end another string are stored inside it. In reversed
+        # order, a suffix sorts directly before the strings that end with it.
+        hosts = {}
+        reversed_strs = sorted(encoded_strs, key=lambda s: s[::-1])
+        for n in range(len(reversed_strs)-1, -1, -1):
+            s = reversed_strs[n]
+            hosts[s] = s
+            if n+1 < len(reversed_strs):
+                following = reversed_strs[n+1]
+                if following.endswith(s):
+                    hosts[s] = hosts[following]
+
+        # The most common string goes first. Every other string that ends no
+        # other string is looked for in the pool so far, so matches inside
+        # longer strings are still reused, and is appended if it is missing.
+        # The index grows with the pool, so no search rescans the pool.
+        pool = bytearray()
+        index = SubstringIndex()
+        offsets = {}
+        for s in [most] + encoded_strs:
+            if s in offsets or (pool and hosts[s] is not s):
                 continue
-            if len(s) % 4:
-                s += b'\x00\x00'
-            assert not len(s) % 4
-            bytecode += s
-        self.text_dump = bytecode
+            offset = index.find(s)
+            if offset < 0:
+                offset = len(pool)
+                appended = s + (b'\x00\x00' if len(s) % 4 else b'')
+                pool += appended
+                index.extend(appended)
+                assert not len(pool) % 4
+            offsets[s] = offset
+        for s in encoded_strs:
+            if s not in offsets:
+                host = hosts[s]
+                offsets[s] = offsets[host] + len(host) - len(s)
+
+        self.text_dump = bytes(pool)
+        self.text_offsets = offsets
         return self.text_dump
 
     def text_to_parameter_bytecode(self, parameter_name, instruction):
         encoded = self.encode(instruction.text_parameters[parameter_name])
-        pointer = self.text_dump.index(encoded)
+        if encoded in self.text_offsets:
+            pointer = self.text_offsets[encoded]
+        else:
+            pointer = self.text_dump.index(encoded)
         return pointer.to_bytes(length=self.config['pointer_size'],
                                 byteorder=self.config['byte_order'])
 
@@ -212,12 +309,238 @@ class ConvertPointerMixin:
             return pointer + self.VIRTUAL_RAM_OFFSET
 
 
+class PropertyCodec:
+    '''
+    One entity property from entity_structures.yaml, compiled into its byte
+    offsets, an optional struct format, and its name/value labels.
+    '''
+    STRUCT_FORMATS = {1: Struct('>B'), 2: Struct('>H'), 4: Struct('>I')}
+
+    def __init__(self, property_name, data):
+        self.property_name = property_name
+        index = data['index']
+        if isinstance(index, int):
+            self.start = index
+            self.finish = index + 1
+        else:
+            self.start, self.finish = index
+            self.finish += 1
+        assert self.finish > self.start
+        self.length = self.finish - self.start
+        self.struct = self.STRUCT_FORMATS.get(self.length)
+        self.labels = {k: v for (k, v) in data.items() if k != 'index'}
+        self.values = {}
+        for value, label in self.labels.items():
+            if label not in self.values:
+                self.values[label] = value
+        self.pretty_format = '{0:0>%sx}' % (self.length * 2)
+
+    def decode(self, data):
+        if self.struct is not None:
+            return self.struct.unpack_from(data, self.start)[0]
+        return int.from_bytes(data[self.start:self.finish], byteorder='big')
+
+    def decode_signed(self, data):
+        value = self.decode(data)
+        if value & (1 << ((8*self.length)-1)):
+            value -= (1 << (8*self.length))
+        return value
+
+    def encode(self, value):
+        if isinstance(value, str):
+            if value in self.values:
+                value = self.values[value]
+            else:
+                value = int(value, 0x10)
+        if value < 0:
+            value = (1 << (8*self.length)) + value
+        return value.to_bytes(length=self.length, byteorder='big')
+
+    def format(self, value):
+        if value in self.labels:
+            return self.labels[value]
+        return self.pretty_format.format(value)
+
+
+class SignatureRegistry:
+    '''
+    Two-way map between entities and their permanent signature labels.
+    Labels are assigned once, from the room's warp index and the entity's
+    index at creation time, and never change when indexes shift later.
+    '''
+    def __init__(self):
+        self.by_label = {}
+        self.by_entity = {}
+        self.next_suffix = {}
+
+    def __contains__(self, key):
+        return key in self.by_label or key in self.by_entity
+
+    def register(self, entity):
+        if entity in self.by_entity:
+            return self.by_entity[entity]
+        label = f'{entity.parent.warp_index:0>3x}-{entity.index:0>3x}'
+        if label in self.by_label:
+            base = label
+            counter = self.next_suffix.get(base, 2)
+            while True:
+                label = f'{base}-{counter}'
+                if label not in self.by_label:
+                    break
+                counter += 1
+            self.next_suffix[base] = counter + 1
+        self.by_label[label] = entity
+        self.by_entity[entity] = label
+        return label
+
+    def unregister(self, entity):
+        label = self.by_entity.pop(entity)
+        del(self.by_label[label])
+        if label.count('-') > 1:
+            base, counter = label.rsplit('-', 1)
+            counter = int(counter)
+            if counter < self.next_suffix.get(base, 2):
+                self.next_suffix[base] = counter
+        return label
+
+    def get(self, label):
+        return self.by_label.get(label)
+
+
+class ExitGraph:
+    '''
+    The exits of every room, indexed by their vanilla destination. Built on
+    first use, which decodes every room; exits that have since been removed
+    or are no longer exits are skipped by every lookup.
+    '''
+    def __init__(self, rooms):
+        self.incoming = defaultdict(list)
+        self.between = defaultdict(list)
+        for mmo in rooms:
+            for e in mmo.exits:
+                dest_room = e.definition.get_property_value('dest_room',
+                                                            old=True)
+                self.incoming[dest_room].append(e)
+                self.between[mmo.warp_index, dest_room].append(e)
+
+    @staticmethod
+    def is_current(exit):
+        _, positions, _ = exit.parent.instance_index
+        return exit in positions and exit.is_exit
+
+    def get_incoming(self, warp_index):
+        return [e for e in self.incoming.get(warp_index, [])
+                if self.is_current(e)]
+
+    def get_pair(self, exit):
+        dest_room = exit.definition.get_property_value('dest_room', old=True)
+        candidates = [c for c in self.between.get(
+                          (dest_room, exit.parent.warp_index), [])
+                      if self.is_current(c)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda c: exit.compare_exit(c))
+
+
+class ActorCatalog:
+    '''
+    Vanilla entity definitions from every room, indexed by actor id, by
+    loading file, and by the values of their properties.
+    '''
+    def __init__(self, rooms):
+        self.by_actor = defaultdict(list)
+        self.by_file = defaultdict(list)
+        self.property_values = defaultdict(set)
+        self.actor_ids_by_file = defaultdict(list)
+        for actor_id, file_index in sorted(MapMetaObject.ENTITY_FILES.items()):
+            self.actor_ids_by_file[file_index].append(actor_id)
+        for mmo in rooms:
+            for d in mmo.old_definitions:
+                actor_id = d.old_actor_id
+                self.by_actor[actor_id].append(d)
+                self.by_file[MapMetaObject.ENTITY_FILES[actor_id]].append(d)
+                if d.old_codecs is None:
+                    continue
+                for property_name, codec in d.old_codecs.items():
+                    self.property_values[property_name].add(
+                            codec.decode(d.old_data))
+
+    def get_definitions(self, actor_id):
+        return self.by_actor.get(actor_id, [])
+
+    def get_values(self, property_name):
+        return sorted(self.property_values.get(property_name, set()))
+
+
+class DefinitionIndex:
+    '''
+    Current room definitions, keyed by actor id and by the values of a few
+    commonly queried properties. Kept up to date as definitions are added,
+    removed, or have their data changed.
+    '''
+    PROPERTIES = ('flag', 'message', 'key_index', 'lock_index')
+
+    def __init__(self):
+        self.by_actor = defaultdict(set)
+        self.by_value = defaultdict(set)
+        self.keys = {}
+
+    def get_keys(self, definition):
+        actor_id = definition.actor_id
+        codecs = definition.codecs or {}
+        values = tuple((property_name,
+                        codecs[property_name].decode(definition.data))
+                       for property_name in self.PROPERTIES
+                       if property_name in codecs)
+        return actor_id, values
+
+    def add(self, definition):
+        if definition in self.keys:
+            self.discard(definition)
+        actor_id, values = self.get_keys(definition)
+        self.by_actor[actor_id].add(definition)
+        for key in values:
+            self.by_value[key].add(definition)
+        self.keys[definition] = (actor_id, values)
+
+    def discard(self, definition):
+        if definition not in self.keys:
+            return
+        actor_id, values = self.keys.pop(definition)
+        self.by_actor[actor_id].discard(definition)
+        for key in values:
+            self.by_value[key].discard(definition)
+
+    def update(self, definition):
+        if definition in self.keys:
+            self.add(definition)
+
+    def find(self, actor_ids=None, **properties):
+        MapMetaObject.decode_all_rooms()
+        results = None
+        if actor_ids is not None:
+            results = set()
+            for actor_id in actor_ids:
+                results |= self.by_actor.get(actor_id, set())
+        for key in properties.items():
+            assert key[0] in self.PROPERTIES
+            matches = self.by_value.get(key, set())
+            results = matches if results is None else results & matches
+        assert results is not None
+        return sorted(results, key=lambda d: (d.parent.index, d.index))
+
+
 class MetaSizeObject(TableObject):
+    # Bumped whenever a file size changes, so cached budgets can tell they
+    # are stale.
+    revision = 0
+
     def get_metasize(self):
         return int.from_bytes(self.metasize_str, byteorder='big')
 
     def set_metasize(self, value):
         self.metasize_str = value.to_bytes(length=3, byteorder='big')
+        MetaSizeObject.revision += 1
 
     def del_metasize(self):
         raise NotImplementedError
@@ -298,6 +621,7 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
         }
     METADATA_LENGTH = 0x1c
     ENTITY_FOOTER_LENGTH = 0x1c
+    GROUP_STRUCT = Struct('>HH')
 
     ENTITY_FILES = {}
     EXTRA_DEPENDENCIES = {
@@ -318,6 +642,13 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
             raise Exception(f'Duplicate structure name: {name}')
         structure_names.add(__name)
 
+    ENTITY_CODECS = {}
+    for __index, __structure in ENTITY_STRUCTURES.items():
+        ENTITY_CODECS[__index] = {
+            __property_name: PropertyCodec(__property_name, __data)
+            for (__property_name, __data) in __structure.items()
+            if isinstance(__data, dict)}
+
     MINIMUM_SAFE_BUDGET = 0xb0000
     PICKUP_FILES = {0x1a, 0x1c, 0x2b}
     ENEMY_FILES = {0x20, 0x21, 0x23, 0x24, 0x25, 0x26, 0x27}
@@ -351,13 +682,30 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
 
     INITIAL_FREE_MEMORY_FLAGS = frozenset(range(0x140, 0x158))
 
+    modification_count = 0
+
     available_memory_flags = set(INITIAL_FREE_MEMORY_FLAGS)
-    entity_signatures = {}
+    rooms_by_warp_index = None
+    _sorted_rooms = None
+    _exit_graph = None
+    _actor_catalog = None
+    all_rooms_decoded = False
+    entity_signatures = SignatureRegistry()
+    indexed_definitions = DefinitionIndex()
 
     class EntityMixin:
         DICT_MATCHER = re.compile('{[^}]*}')
 
-        def __init__(self, data, parent, index=None, validate=True):
+        # Entity data is a mutable bytearray, written in place. The vanilla
+        # data in old_data is a memoryview into the decompressed file when
+        # decoded from one, and otherwise an immutable bytes copy; bytearray
+        # input is copied so that later writes to it cannot leak in.
+        __slots__ = ('parent', 'index', '_data', 'old_data', '_property_cache')
+
+        def __init__(self, data, parent, index=None, validate=True,
+                     check_index=True):
+            # Decoders number records in file order themselves and pass
+            # check_index=False, since each duplicate check walks the room.
             assert len(data) == self.DATA_LENGTH
             self.parent = parent
             if index is None:
@@ -365,6 +713,8 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
                     self.index = max(e.index for e in self.parent.entities) + 1
                 else:
                     self.index = 0
+            elif not check_index:
+                self.index = index
             else:
                 for e in self.parent.entities:
                     if e.index == index:
@@ -372,7 +722,9 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
                             f'{self.parent.warp_index:0>3x}-{index:0>3x} '
                             f'is a duplicate entity.')
                 self.index = index
-            self.data = data
+            self._data = bytearray(data)
+            if isinstance(data, bytearray):
+                data = bytes(data)
             self.old_data = data
             if validate:
                 self.validate_data()
@@ -398,41 +750,35 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
                 s = hexified
             return s
 
+        @property
+        def data(self):
+            return self._data
+
+        @data.setter
+        def data(self, data):
+            assert len(data) == self.DATA_LENGTH
+            self._data[:] = data
+            self.parent.mark_changed()
+            MapMetaObject.indexed_definitions.update(self)
+
         @property
         def is_null(self):
-            return set(self.data) == {0}
+            return not any(self._data)
 
         @property
         def signature(self):
-            if self in MapMetaObject.entity_signatures:
-                return MapMetaObject.entity_signatures[self]
-            parent_index = f'{self.parent.warp_index:0>3x}'
-            name = self.name.strip()
-            if '#' in name:
-                name = name.split('#')[0].strip()
-            signature = f'{parent_index}-{self.index:0>3x}'
-            if signature in MapMetaObject.entity_signatures:
-                counter = 2
-                while True:
-                    test = f'{signature}-{counter}'
-                    if test not in MapMetaObject.entity_signatures:
-                        break
-                    counter += 1
-                signature = test
-            MapMetaObject.entity_signatures[signature] = self
-            MapMetaObject.entity_signatures[self] = signature
-            return self.signature
+            return MapMetaObject.entity_signatures.register(self)
 
         @property
         def converted_signature(self):
+            signature = self.signature
             if get_global_label() != 'MN64_EN':
-                return self.signature
-            mapping = MapMetaObject.EN_JP_NODE_MAPPING
-            if self.signature in mapping:
-                return mapping[self.signature]
-            if self.signature in mapping.values():
-                return f'{self.signature}-0'
-            return self.signature
+                return signature
+            if signature in MapMetaObject.EN_JP_NODE_MAPPING:
+                return MapMetaObject.EN_JP_NODE_MAPPING[signature]
+            if signature in MapMetaObject.JP_EN_NODE_MAPPING:
+                return f'{signature}-0'
+            return signature
 
         @property
         def details(self):
@@ -442,30 +788,28 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
                 return None
 
             unsorted_details = []
-            for property_name, data in self.structure.items():
+            for property_name, codec in self.codecs.items():
                 if property_name == self.MAIN_PROPERTY_NAME:
                     continue
                 if (hasattr(self, 'DETAIL_PROPERTIES') and
                         property_name not in self.DETAIL_PROPERTIES):
                     continue
 
-                start, finish = self.get_property_indexes(property_name)
-                value = self.get_property_value(property_name)
+                value = codec.decode(self._data)
                 if 0xf001 <= value <= 0xffff:
                     value = -(0x10000-value)
                     pretty_value = f'-{abs(value):0>4x}'
                 else:
-                    pretty_value = ('{0:0>%sx}' %
-                                    ((finish-start)*2)).format(value)
+                    pretty_value = codec.pretty_format.format(value)
                 pretty_name = f'{property_name}:'
                 if len(pretty_value) % 2:
                     pretty_value = f'@ {pretty_name:14} {pretty_value}'
                 else:
                     pretty_value = f'@ {pretty_name:15} {pretty_value}'
-                if value in data:
-                    pretty_value = f'{pretty_value:26}# {data[value]}'
+                if value in codec.labels:
+                    pretty_value = f'{pretty_value:26}# {codec.labels[value]}'
 
-                unsorted_details.append((start, pretty_value))
+                unsorted_details.append((codec.start, pretty_value))
             details = [v for (s, v) in sorted(unsorted_details)]
             details.insert(0, f'@ {self.name}')
             return '\n'.join(details)
@@ -475,64 +819,35 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
 
         def get_property_indexes(self, property_name, old=False):
             if old:
-                data = self.old_structure[property_name]
+                codec = self.old_codecs[property_name]
             else:
-                data = self.structure[property_name]
-            index = data['index']
-            if isinstance(index, int):
-                start = index
-                finish = index + 1
-            else:
-                start, finish = index
-                finish += 1
-            assert finish > start
-            return start, finish
+                codec = self.codecs[property_name]
+            return codec.start, codec.finish
 
         def get_property_value(self, property_name, old=False):
             if old:
-                start, finish = self.get_property_indexes(property_name,
-                                                          old=True)
-                value = int.from_bytes(self.old_data[start:finish],
-                                       byteorder='big')
-            else:
-                start, finish = self.get_property_indexes(property_name)
-                value = int.from_bytes(self.data[start:finish],
-                                       byteorder='big')
-            return value
+                return self.old_codecs[property_name].decode(self.old_data)
+            return self.codecs[property_name].decode(self._data)
+
+        def get_signed_value(self, property_name, old=False):
+            if old:
+                return self.old_codecs[property_name].decode_signed(
+                        self.old_data)
+            return self.codecs[property_name].decode_signed(self._data)
 
         def get_pretty_value(self, property_name, old=False):
             value = self.get_property_value(property_name, old)
-            if value in self.structure[property_name]:
-                return self.structure[property_name][value]
-            index = self.structure[property_name]['index']
-            if isinstance(index, int):
-                length = 1
-            else:
-                a, b = index
-                length = (b+1) - a
-            length *= 2
-            return ('{0:0>%sx}' % length).format(value)
+            return self.codecs[property_name].format(value)
 
         def set_property(self, property_name, value):
-            if self.structure is None or property_name not in self.structure:
+            if self.codecs is None or property_name not in self.codecs:
                 raise Exception(f'Entity {self.signature} has no '
                                 f'"{property_name}" property.')
-            data = self.structure[property_name]
-            start, finish = self.get_property_indexes(property_name)
-            if isinstance(value, str):
-                for i, name in self.structure[property_name].items():
-                    if name == value:
-                        value = i
-                        break
-                else:
-                    value = int(value, 0x10)
-            value_length = finish - start
-            if value < 0:
-                value = (1 << (8*value_length)) + value
-            value = value.to_bytes(length=value_length, byteorder='big')
-            data = self.data[:start] + value + self.data[finish:]
-            assert len(data) == len(self.data)
-            self.data = data
+            codec = self.codecs[property_name]
+            self._data[codec.start:codec.finish] = codec.encode(value)
+            self.parent.mark_changed()
+            if property_name in DefinitionIndex.PROPERTIES:
+                MapMetaObject.indexed_definitions.update(self)
 
         def import_details(self, details):
             dict_matches = self.DICT_MATCHER.findall(details)
@@ -551,6 +866,7 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
     class EntityDefinition(EntityMixin):
         DATA_LENGTH = 0x10
         MAIN_PROPERTY_NAME = 'name'
+        __slots__ = ()
 
         DOOR_DESIGNS = {
             0x23a: set(),
@@ -623,9 +939,17 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
                 return None
             return MapMetaObject.ENTITY_STRUCTURES[self.old_actor_id]
 
+        @property
+        def codecs(self):
+            return MapMetaObject.ENTITY_CODECS.get(self.actor_id)
+
+        @cached_property
+        def old_codecs(self):
+            return MapMetaObject.ENTITY_CODECS.get(self.old_actor_id)
+
         @property
         def instances(self):
-            return [i for i in self.parent.instances if i.definition is self]
+            return list(self.parent.get_definition_instances(self))
 
         @property
         def is_exit(self):
@@ -723,6 +1047,12 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
             return MapMetaObject.get_by_warp_index(
                     self.get_property_value('dest_room'))
 
+        @cached_property
+        def old_destination(self):
+            assert self.is_exit
+            return tuple(self.get_signed_value(pname, old=True)
+                         for pname in ('dest_x', 'dest_y', 'dest_z'))
+
         @cached_property
         def destination_has_same_bgm(self):
             assert self.is_exit
@@ -741,26 +1071,12 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
                             f'-> {dest_room:0>3x}')
 
         def remove(self):
-            associations = [(d, d.instances) for d in self.parent.definitions]
-            for group, instances in self.parent.spawn_groups.items():
-                self.parent.spawn_groups[group] = [i for i in instances
-                                                   if i not in self.instances]
-            self.parent.definitions.remove(self)
-            for n, definition in enumerate(self.parent.definitions):
-                definition.index = n
-                for (d, instances) in associations:
-                    if d is definition:
-                        for i in instances:
-                            i.set_main_property(definition.index)
-            assert self not in self.parent.entities
-            for i in self.instances:
-                assert i not in self.parent.entities
+            self.parent.remove_definitions([self])
 
         def set_main_property(self, value):
-            actor_id = value.to_bytes(length=2, byteorder='big')
-            data = actor_id + self.data[2:]
-            assert len(data) == len(self.data)
-            self.data = data
+            self._data[:2] = value.to_bytes(length=2, byteorder='big')
+            self.parent.mark_changed()
+            MapMetaObject.indexed_definitions.update(self)
             assert self.actor_id == value
 
         def set_exit_id(self, exit_id):
@@ -876,12 +1192,8 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
         def randomize_pot(self):
             POT_INDEX = 0x192
             assert self.actor_id == POT_INDEX
-            if not hasattr(MapMetaObject, '_pots'):
-                pots = [e for mmo in MapMetaObject.sorted_rooms
-                        for e in mmo.definitions
-                        if e.old_actor_id == POT_INDEX]
-                MapMetaObject._pots = pots
-            chosen = random.choice(MapMetaObject._pots)
+            pots = MapMetaObject.actor_catalog.get_definitions(POT_INDEX)
+            chosen = random.choice(pots)
             self.set_property('spawn_id',
                               chosen.get_property_value('spawn_id'))
             old_num_spawn = chosen.get_property_value('num_spawn')
@@ -898,6 +1210,7 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
         DATA_LENGTH = 0x14
         MAIN_PROPERTY_NAME = 'definition_index'
         DETAIL_PROPERTIES = ['x', 'y', 'z', 'rotx', 'roty', 'rotz']
+        __slots__ = ('_old_definition',)
 
         structure = {'definition_index':    {'index': (0xe, 0xf)},
                      'x':                   {'index': (0x0, 0x1)},
@@ -908,6 +1221,9 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
                      'roty':                {'index': (0xa, 0xb)},
                      }
         old_structure = structure
+        codecs = {property_name: PropertyCodec(property_name, data)
+                  for (property_name, data) in structure.items()}
+        old_codecs = codecs
 
         @property
         def definition_index(self):
@@ -937,14 +1253,14 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
                 return None
             if self.definition_index is None:
                 return None
-            if self.definition_index >= len(self.parent.entities):
+            # Entities are ordered definitions first, so any index past the
+            # definitions would point at an instance.
+            if self.definition_index >= len(self.parent.definitions):
                 return None
-            definition = self.parent.entities[self.definition_index]
-            if isinstance(definition, MapMetaObject.EntityDefinition):
-                if not hasattr(self, '_old_definition'):
-                    self._old_definition = definition
-                return definition
-            return None
+            definition = self.parent.definitions[self.definition_index]
+            if not hasattr(self, '_old_definition'):
+                self._old_definition = definition
+            return definition
 
         @property
         def old_definition(self):
@@ -980,26 +1296,17 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
 
         @property
         def is_unique(self):
-            return len([i for i in self.parent.instances
-                        if i.definition is self.definition]) == 1
+            if self.definition is None:
+                return len([i for i in self.parent.instances
+                            if i.definition is None]) == 1
+            return len(self.parent.get_definition_instances(
+                self.definition)) == 1
 
         @property
         def exit_pair(self):
             if not self.is_exit:
                 return None
-            coparent = MapMetaObject.get_by_warp_index(
-                self.definition.get_property_value('dest_room', old=True))
-            candidates = coparent.exits
-            candidates = [c for c in candidates
-                          if c.definition.get_property_value('dest_room',
-                                                             old=True)
-                          == self.parent.warp_index]
-            if len(candidates) > 1:
-                candidates = sorted(candidates,
-                                    key=lambda c: self.compare_exit(c))
-            if not candidates:
-                return None
-            return candidates[0]
+            return MapMetaObject.exit_graph.get_pair(self)
 
         @property
         def lock(self):
@@ -1008,17 +1315,15 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
             locks = [i for i in self.parent.instances if i.is_lock]
             if not locks:
                 return None
-            exits = self.parent.exits
-            assert self in exits
-            selections = {}
+            assert self in self.parent.exits
+            exits_by_position = self.parent.get_instances_by_position(
+                    self.parent.exits)
+            chosen = []
             for l in locks:
-                exits = sorted(exits, key=lambda x: x.get_distance(l))
-                x = exits[0]
-                assert x.get_distance(l) == 0
-                if len(exits) > 1:
-                    assert exits[1].get_distance(l) > 0
-                selections[l] = x
-            chosen = [l for l in locks if selections[l] is self]
+                exits = exits_by_position[self.parent.get_position(l)]
+                assert len(exits) == 1
+                if exits[0] is self:
+                    chosen.append(l)
             assert len(chosen) < 2
             if chosen:
                 return chosen[0]
@@ -1033,17 +1338,20 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
             zone = self.definition.get_property_value('zone')
             return f'{zone}.{lock_index:0>3x}.{key_type}'
 
+        @property
+        def position(self):
+            return tuple(self.get_signed_value(pname)
+                         for pname in ('x', 'y', 'z'))
+
+        @cached_property
+        def old_position(self):
+            return tuple(self.get_signed_value(pname, old=True)
+                         for pname in ('x', 'y', 'z'))
+
         def get_distance(self, other):
             assert self.parent is other.parent
-            distances = []
-            for pname in ['x', 'y', 'z']:
-                positions = (self.get_property_value(pname),
-                             other.get_property_value(pname))
-                positions = [(v - 0x10000) if v & 0x8000 else v
-                             for v in positions]
-                diff = abs(positions[0] - positions[1])
-                distances.append(diff)
-            return sum(v**2 for v in distances)
+            return squared_distance(self.parent.get_position(self),
+                                    self.parent.get_position(other))
 
         def compare_exit(self, other):
             assert self.is_exit and other.is_exit
@@ -1051,45 +1359,30 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
                     == other.parent.warp_index
             assert other.definition.get_property_value('dest_room', old=True) \
                     == self.parent.warp_index
-            distances = []
-            for (a, b) in [(self, other), (other, self)]:
-                for pname in ['x', 'y', 'z']:
-                    dname = 'dest_%s' % pname
-                    positions = (a.get_property_value(pname, old=True),
-                                 b.definition.get_property_value(dname,
-                                                                 old=True))
-                    positions = [(v - 0x10000) if v & 0x8000 else v
-                                 for v in positions]
-                    diff = abs(positions[0] - positions[1])
-                    distances.append(diff)
-            return sum(v**2 for v in distances)
+            return (squared_distance(self.old_position,
+                                     other.definition.old_destination) +
+                    squared_distance(other.old_position,
+                                     self.definition.old_destination))
 
         def set_main_property(self, value):
+            old_definition = self.definition
             if (hasattr(self, '_property_cache') and
                     'definition' in self._property_cache):
                 del(self._property_cache['definition'])
             self.set_property('definition_index', value << 4)
+            self.parent.move_instance(self, old_definition, self.definition)
 
         def acquire_destination(self, warp_index, exit_index=None):
             assert self.is_exit
-            exits = []
-            for mmo in MapMetaObject.sorted_rooms:
-                exits += [
-                    e for e in mmo.exits if warp_index ==
-                    e.definition.get_property_value('dest_room', old=True)]
+            exits = MapMetaObject.exit_graph.get_incoming(warp_index)
 
             if not exits:
                 return
 
-            def get_height(exit):
-                height = exit.definition.get_property_value('dest_z', old=True)
-                if height & 0x8000:
-                    height = height - 0x10000
-                return height
-
             if exit_index is None:
-                exits = sorted(exits, key=lambda e: (get_height(e), e.index))
-                chosen = exits[-1]
+                # highest destination; ties go to the last exit listed
+                chosen = max(reversed(exits), key=lambda e: (
+                    e.definition.old_destination[2], e.index))
             else:
                 mmo = MapMetaObject.get_by_warp_index(warp_index)
                 exit = mmo.entities[exit_index]
@@ -1103,13 +1396,6 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
 
         def spawn_door_blocker(self):
             BLOCKER_INDEX = 0x328
-            if not hasattr(self, '_blocker_messages'):
-                messages = set()
-                for mmo in MapMetaObject.sorted_rooms:
-                    for e in mmo.definitions:
-                        if 'message' in e.structure:
-                            messages.add(e.get_property_value('message'))
-                self._blocker_messages = sorted(messages)
             candidates = [b for b in self.parent.definitions
                           if b.actor_id == BLOCKER_INDEX]
             if candidates:
@@ -1118,15 +1404,15 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
                 data = b'\x00' * len(self.definition.data)
                 blocker = self.parent.add_new_definition(data)
                 blocker.set_main_property(BLOCKER_INDEX)
-                blocker.set_property('message',
-                                     random.choice(self._blocker_messages))
+                messages = MapMetaObject.actor_catalog.get_values('message')
+                blocker.set_property('message', random.choice(messages))
             data = b'\x00' * len(self.data)
             blocker_instance = self.parent.EntityInstance(data, self.parent)
             for attr in self.DETAIL_PROPERTIES:
                 blocker_instance.set_property(attr,
                                               self.get_property_value(attr))
             blocker_instance.set_main_property(blocker.index)
-            self.parent.spawn_groups[(-1,-1,-1)].append(blocker_instance)
+            self.parent.add_instance(blocker_instance)
             blocker_instance.clean()
             assert blocker_instance in self.parent.instances
 
@@ -1137,7 +1423,8 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
         def clean(self):
             if self.is_null:
                 return
-            self.data = self.data[:12] + b'\x08\x00' + self.data[14:]
+            self._data[12:14] = b'\x08\x00'
+            self.parent.mark_changed()
 
         def validate_data(self):
             if self.is_null:
@@ -1162,9 +1449,44 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
 
     @classproperty
     def sorted_rooms(self):
-        return sorted(
-            (mmo for mmo in self.every if mmo.is_room),
-            key=lambda x: x.warp_index)
+        if MapMetaObject._sorted_rooms is None:
+            MapMetaObject.build_room_registry()
+        return MapMetaObject._sorted_rooms
+
+    @classmethod
+    def build_room_registry(self):
+        # Warp indexes only change in read_loading_files, so the lookup
+        # array and room list are built once and reused until invalidated.
+        rooms_by_warp_index = [None] * (self.MAX_WARP_INDEX + 1)
+        for mmo in MapMetaObject.every:
+            if getattr(mmo, 'warp_index', None) is None:
+                continue
+            assert rooms_by_warp_index[mmo.warp_index] is None
+            rooms_by_warp_index[mmo.warp_index] = mmo
+        MapMetaObject.rooms_by_warp_index = rooms_by_warp_index
+        MapMetaObject._sorted_rooms = tuple(sorted(
+            (mmo for mmo in MapMetaObject.every if mmo.is_room),
+            key=lambda x: x.warp_index))
+
+    @classproperty
+    def exit_graph(self):
+        if MapMetaObject._exit_graph is None:
+            MapMetaObject._exit_graph = ExitGraph(MapMetaObject.sorted_rooms)
+        return MapMetaObject._exit_graph
+
+    @classproperty
+    def actor_catalog(self):
+        if MapMetaObject._actor_catalog is None:
+            MapMetaObject._actor_catalog = ActorCatalog(
+                    MapMetaObject.sorted_rooms)
+        return MapMetaObject._actor_catalog
+
+    @classmethod
+    def invalidate_room_registry(self):
+        MapMetaObject.rooms_by_warp_index = None
+        MapMetaObject._sorted_rooms = None
+        MapMetaObject._exit_graph = None
+        MapCategoryData._every = None
 
     @classmethod
     def read_loading_files(self):
@@ -1234,17 +1556,68 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
                     warp_loads.append(value)
                 mmo.loading_files = warp_loads
                 mmo.old_loading_files = list(mmo.loading_files)
-                mmo.total_budget = max(mmo.total_size, mmo.MINIMUM_SAFE_BUDGET)
-                mmo.enemy_budget = mmo.enemy_size
-                mmo.pickup_budget = mmo.pickup_size
                 data_end = max(data_end, f.tell())
 
+        self.build_room_registry()
+
+        # Budgets read misc data by warp index, so they wait until every room
+        # has its warp index.
+        for mmo in MapMetaObject.every:
+            if getattr(mmo, 'warp_index', None) is None:
+                continue
+            if not hasattr(mmo, 'loading_files'):
+                continue
+            mmo.total_budget = max(mmo.total_size, mmo.MINIMUM_SAFE_BUDGET)
+            mmo.enemy_budget = mmo.enemy_size
+            mmo.pickup_budget = mmo.pickup_size
+
         MapMetaObject.loading_data_start = data_start
         MapMetaObject.loading_data_end = data_end
         MapMetaObject.loading_routine_start = routine_start
         MapMetaObject.loading_routine_end = routine_end
         return
 
+    @classmethod
+    def read_room_metadata(self, main_code_data):
+        room_metadata = {}
+        with BytesIO(main_code_data) as f:
+            for warp_index in range(self.MAX_WARP_INDEX + 1):
+                base_pointer = self.convert_pointer(
+                        self.POINTER_TABLE_OFFSET+(warp_index*4))
+                f.seek(base_pointer)
+                pointer = int.from_bytes(f.read(4), byteorder='big')
+                if pointer == 0:
+                    continue
+                f.seek(self.convert_pointer(pointer))
+                metadata = f.read(self.METADATA_LENGTH)
+                metadata = {
+                    attribute: int.from_bytes(metadata[a:b], byteorder='big')
+                    for (attribute, (a, b)) in self.METADATA_STRUCTURE.items()}
+                if metadata['actor_file_index'] <= 0:
+                    continue
+                room_metadata[warp_index] = metadata
+        return room_metadata
+
+    @classmethod
+    def read_pointer_table(self, filename):
+        with open(filename, 'rb') as f:
+            reference_pointers = []
+            for mmo in self.every:
+                f.seek(mmo.pointer)
+                reference_pointers.append(
+                        int.from_bytes(f.read(4), byteorder='big'))
+            compressed = []
+            for (n, pointer) in enumerate(reference_pointers):
+                start = pointer & 0x7fffffff
+                if n + 1 < len(reference_pointers):
+                    finish = reference_pointers[n+1] & 0x7fffffff
+                else:
+                    finish = start
+                finish = max(start, finish)
+                f.seek(start)
+                compressed.append(f.read(finish-start))
+        return reference_pointers, compressed
+
     @classmethod
     def write_loading_files(self):
         main_code = self.get_by_file_index(self.MAIN_CODE_FILE_INDEX)
@@ -1257,9 +1630,7 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
         f.write(b'\x00' * (data_end-data_start))
         f.seek(routine_start)
         f.write(b'\x00' * (routine_end-routine_start))
-        data_buffer = b''
-        routine_buffer = b''
-
+        room_lists = []
         for warp_index in range(self.MAX_WARP_INDEX + 1):
             mmo = MapMetaObject.get_by_warp_index(warp_index)
             if mmo is None:
@@ -1284,36 +1655,51 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
             data_list = b''.join([v.to_bytes(length=2, byteorder='big')
                                   for v in values])
             data_list += b'\x00\x00'
-            for i in range(len(data_buffer)//4):
-                index = i*4
-                if data_buffer[index:index+len(data_list)] == data_list:
-                    break
-            else:
-                while len(data_buffer) % 4:
-                    data_buffer += b'\x00'
-                index = len(data_buffer)
-                data_buffer += data_list
+            room_lists.append((warp_index, mmo, data_list))
+
+        # Lists are packed longest first, and every 4-aligned tail of a
+        # packed list is indexed, so a list that is the tail of another
+        # list shares its storage and terminator.
+        data_buffer = bytearray()
+        list_offsets = {}
+        unique_lists = dict.fromkeys(data_list for (_, _, data_list)
+                                     in room_lists)
+        for data_list in sorted(unique_lists, key=len, reverse=True):
+            if data_list in list_offsets:
+                continue
+            while len(data_buffer) % 4:
+                data_buffer.append(0)
+            index = len(data_buffer)
+            data_buffer += data_list
+            for i in range(0, len(data_list), 4):
+                list_offsets.setdefault(data_list[i:], index + i)
+
+        routine_buffer = bytearray()
+        routine_offsets = {}
+        for warp_index, mmo, data_list in room_lists:
+            index = list_offsets[data_list]
             assert index % 4 == 0
             list_pointer = self.convert_pointer(data_start+index)
             offset = (list_pointer & 0xffff).to_bytes(length=2,
                                                       byteorder='big')
             routine = (self.LOADING_CODE_HEADER + offset
                        + self.LOADING_CODE_FOOTER)
-            if routine in routine_buffer:
-                routine_offset = routine_buffer.index(routine)
-            else:
-                routine_offset = len(routine_buffer)
+            if routine not in routine_offsets:
+                routine_offsets[routine] = len(routine_buffer)
                 routine_buffer += routine
+            routine_offset = routine_offsets[routine]
             assert routine_offset % 4 == 0
             loading_pointer = self.convert_pointer(routine_start +
                                                    routine_offset)
             mmo.loading_pointer = loading_pointer | 0x80000000
 
-            mmo.instance_offset = (
-                len(mmo.definitions) * mmo.EntityDefinition.DATA_LENGTH)
-            instance_data, _ = mmo.get_instance_data()
-            mmo.footer_offset = mmo.instance_offset + len(instance_data)
-            mmo.ending_offset = mmo.footer_offset + self.ENTITY_FOOTER_LENGTH
+            if mmo.is_decoded:
+                mmo.instance_offset = (
+                    len(mmo.definitions) * mmo.EntityDefinition.DATA_LENGTH)
+                instance_data, _ = mmo.get_instance_data()
+                mmo.footer_offset = mmo.instance_offset + len(instance_data)
+                mmo.ending_offset = \
+                    mmo.footer_offset + self.ENTITY_FOOTER_LENGTH
 
             metadata_length = max(max(self.METADATA_STRUCTURE.values()))
             assert metadata_length == self.METADATA_LENGTH
@@ -1346,16 +1732,13 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
         f.close()
 
     @classmethod
-    @lru_cache(maxsize=None)
     def get_by_warp_index(self, index):
         assert self is MapMetaObject
-        choices = [mmo for mmo in MapMetaObject.every
-                   if hasattr(mmo, 'warp_index')
-                   and mmo.warp_index == index]
-        if not choices:
+        if MapMetaObject.rooms_by_warp_index is None:
+            MapMetaObject.build_room_registry()
+        if not 0 <= index < len(MapMetaObject.rooms_by_warp_index):
             return None
-        assert len(choices) == 1
-        return choices[0]
+        return MapMetaObject.rooms_by_warp_index[index]
 
     @classmethod
     def get_by_file_index(self, index):
@@ -1367,14 +1750,16 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
         if convert and get_global_label() == 'MN64_EN' and \
                 signature in self.JP_EN_NODE_MAPPING:
             signature = self.JP_EN_NODE_MAPPING[signature]
-        if signature in MapMetaObject.entity_signatures:
-            return MapMetaObject.entity_signatures[signature]
-        warp_index = signature.split('-')[0]
-        mmo = MapMetaObject.get_by_warp_index(int(warp_index, 0x10))
-        for e in mmo.entities:
-            if e.signature == signature:
-                return e
-        raise Exception(f'No entity: {signature}')
+        entity = MapMetaObject.entity_signatures.get(signature)
+        if entity is None:
+            warp_index = int(signature.split('-')[0], 0x10)
+            mmo = MapMetaObject.get_by_warp_index(warp_index)
+            if mmo is not None and mmo.is_room and not mmo.is_decoded:
+                mmo.decode_entities()
+                entity = MapMetaObject.entity_signatures.get(signature)
+        if entity is None:
+            raise Exception(f'No entity: {signature}')
+        return entity
 
     @classmethod
     def import_from_file(self, filename):
@@ -1597,29 +1982,113 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
     def metasize(self):
         return MetaSizeObject.get_by_file_index(self.file_index)
 
+    def get_loading_files(self):
+        return self._loading_files
+
+    def set_loading_files(self, loading_files):
+        self._loading_files = list(loading_files)
+        self.invalidate_budget()
+
+    loading_files = property(get_loading_files, set_loading_files)
+
+    def add_loading_file(self, file_index):
+        assert file_index != 0
+        is_new = file_index not in self.loading_files
+        self.loading_files.append(file_index)
+        if not self.budget_is_current:
+            return
+        size = MetaSizeObject.get_by_file_index(file_index).effective_metasize
+        self._budget['total'] += size
+        if is_new and file_index in self.ENEMY_FILES:
+            self._budget['enemy'] += size
+        if is_new and file_index in self.PICKUP_FILES:
+            self._budget['pickup'] += size
+
+    def remove_loading_file(self, file_index):
+        self.loading_files.remove(file_index)
+        if not self.budget_is_current:
+            return
+        size = MetaSizeObject.get_by_file_index(file_index).effective_metasize
+        self._budget['total'] -= size
+        is_gone = file_index not in self.loading_files
+        if is_gone and file_index in self.ENEMY_FILES:
+            self._budget['enemy'] -= size
+        if is_gone and file_index in self.PICKUP_FILES:
+            self._budget['pickup'] -= size
+
+    def invalidate_budget(self):
+        self._budget = None
+
+    @property
+    def misc_loading_files(self):
+        return tuple(l for l in self.misc_data.loading_files if l > 0)
+
+    @property
+    def budget_is_current(self):
+        return (getattr(self, '_budget', None) is not None
+                and self._budget['revision'] == MetaSizeObject.revision
+                and self._budget['misc'] == self.misc_loading_files)
+
+    @property
+    def budget(self):
+        # Running totals of loaded file sizes. Recomputed from scratch only
+        # when a file size changes or the misc loading files are replaced.
+        if not self.budget_is_current:
+            misc_loading_files = self.misc_loading_files
+            loading_files = list(self.loading_files) + list(misc_loading_files)
+            assert 0 not in loading_files
+            sizes = {index: MetaSizeObject.get_by_file_index(
+                        index).effective_metasize
+                     for index in set(loading_files)}
+            self._budget = {
+                'revision': MetaSizeObject.revision,
+                'misc': misc_loading_files,
+                'total': sum(sizes[index] for index in loading_files),
+                'enemy': sum(sizes[index] for index in
+                             set(self.loading_files) & self.ENEMY_FILES),
+                'pickup': sum(sizes[index] for index in
+                              set(self.loading_files) & self.PICKUP_FILES),
+                }
+        return self._budget
+
     @property
     def total_size(self):
         if not hasattr(self, 'loading_files'):
             return None
-        loading_files = list(self.loading_files)
-        loading_files += [l for l in self.misc_data.loading_files if l > 0]
-        assert 0 not in loading_files
-        return sum([MetaSizeObject.get_by_file_index(index).effective_metasize
-                    for index in loading_files])
+        return self.budget['total']
 
     @property
     def enemy_size(self):
         assert self.total_size
-        enemy_files = set(self.loading_files) & self.ENEMY_FILES
-        return sum([MetaSizeObject.get_by_file_index(index).effective_metasize
-                    for index in enemy_files])
+        return self.budget['enemy']
 
     @property
     def pickup_size(self):
         assert self.total_size
-        pickup_files = set(self.loading_files) & self.PICKUP_FILES
-        return sum([MetaSizeObject.get_by_file_index(index).effective_metasize
-                    for index in pickup_files])
+        return self.budget['pickup']
+
+    @property
+    def cuttable_enemy_files(self):
+        # Enemy files that validate_budget drops when no instance uses them
+        return {f for f in set(self.loading_files) & self.ENEMY_FILES
+                if f not in self.old_loading_files
+                or f in self.old_instance_loading_files}
+
+    @property
+    def base_budget(self):
+        return self.total_size - sum(
+            MetaSizeObject.get_by_file_index(f).effective_metasize
+            for f in self.cuttable_enemy_files)
+
+    @classmethod
+    def budget_report(self):
+        lines = ['ROOM  USED     BUDGET   HEADROOM']
+        for mmo in MapMetaObject.sorted_rooms:
+            used = mmo.total_size
+            lines.append(f'{mmo.warp_index:0>3x}   {used:>7x}  '
+                         f'{mmo.total_budget:>7x}  '
+                         f'{mmo.total_budget-used:>8x}')
+        return '\n'.join(lines)
 
     @property
     def other_size(self):
@@ -1630,43 +2099,97 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
         if hasattr(self, '_data'):
             return self._data
         if self.is_room:
-            data = b''
-            for e in self.definitions:
-                data += e.data
-
-            definitions_length = len(data)
+            if hasattr(self, '_cached_data'):
+                return self._cached_data
+            chunks = [e.data for e in self.definitions]
+            definitions_length = (len(self.definitions) *
+                                  self.EntityDefinition.DATA_LENGTH)
             instance_data, group_offsets = self.get_instance_data()
-            data += instance_data
-
-            data += self.footer
-            for x in range(self.groups_x):
-                for z in range(self.groups_z):
-                    for y in range(self.groups_y):
-                        if (x, z, y) not in group_offsets:
-                            data += b'\x00\x00\x00\x00'
-                            continue
-                        data += b'\x08\x00'
-                        value = group_offsets[x,z,y] + definitions_length
-                        data += value.to_bytes(length=2, byteorder='big')
+            chunks.append(instance_data)
+            chunks.append(self.footer)
+            for key in product(range(self.groups_x), range(self.groups_z),
+                               range(self.groups_y)):
+                if key not in group_offsets:
+                    chunks.append(self.GROUP_STRUCT.pack(0, 0))
+                    continue
+                chunks.append(self.GROUP_STRUCT.pack(
+                    0x800, group_offsets[key] + definitions_length))
 
-            return data
+            self._cached_data = b''.join(chunks)
+            return self.data
         if self.file_index == self.MAIN_CODE_FILE_INDEX:
             assert hasattr(self, '_data')
         return None
 
+    def mark_changed(self):
+        # Invalidates the serialized room whenever an entity, the spawn groups,
+        # the definitions list, or the footer is modified.
+        self.modification_count += 1
+        if hasattr(self, '_cached_data'):
+            del(self._cached_data)
+
+    def get_definitions(self):
+        if '_definitions' not in self.__dict__ and self.is_room:
+            self.decode_entities()
+        return self._definitions
+
+    def set_definitions(self, definitions):
+        for d in getattr(self, '_definitions', []):
+            MapMetaObject.indexed_definitions.discard(d)
+        for d in definitions:
+            MapMetaObject.indexed_definitions.add(d)
+        self._definitions = definitions
+        self.invalidate_instances()
+        self.mark_changed()
+
+    definitions = property(get_definitions, set_definitions)
+
+    def get_spawn_groups(self):
+        if '_spawn_groups' not in self.__dict__ and self.is_room:
+            self.decode_entities()
+        return self._spawn_groups
+
+    def set_spawn_groups(self, spawn_groups):
+        self._spawn_groups = spawn_groups
+        self.invalidate_instances()
+        self.mark_changed()
+
+    spawn_groups = property(get_spawn_groups, set_spawn_groups)
+
+    def get_footer(self):
+        if '_footer' not in self.__dict__ and self.is_room:
+            self.decode_entities()
+        return self._footer
+
+    def set_footer(self, footer):
+        self._footer = footer
+        self.mark_changed()
+
+    footer = property(get_footer, set_footer)
+
     @property
     def data_has_changed(self):
         if self.is_rom_split:
             return False
-        if self.data is None:
+        if (hasattr(self, 'unmodified_count')
+                and self.modification_count == self.unmodified_count):
             return False
-        old_data = self._cached_decompressed
         data = self.data
-        while len(data) < len(old_data):
-            data += b'\x00'
-        while len(old_data) < len(data):
-            old_data += b'\x00'
-        return data != old_data
+        if data is None:
+            return False
+        if hasattr(self, '_changed_check') and self._changed_check[0] is data:
+            return self._changed_check[1]
+        old_data = self.get_decompressed()
+        if data is old_data:
+            has_changed = False
+        elif len(data) == len(old_data):
+            has_changed = data != old_data
+        else:
+            length = max(len(data), len(old_data))
+            has_changed = (data.ljust(length, b'\x00') !=
+                           old_data.ljust(length, b'\x00'))
+        self._changed_check = (data, has_changed)
+        return has_changed
 
     @property
     def is_room(self):
@@ -1700,12 +2223,53 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
     def exits(self):
         return [e for e in self.instances if e.is_exit]
 
+    @property
+    def instance_index(self):
+        # The flattened instance list and definition -> instances adjacency
+        # are rebuilt only after the spawn groups or definitions are
+        # restructured; definition changes are applied by move_instance.
+        if getattr(self, '_instance_index', None) is None:
+            instances = []
+            for key in sorted(self.spawn_groups):
+                instances += self.spawn_groups[key]
+            positions = {i: n for (n, i) in enumerate(instances)}
+            adjacency = {d: [] for d in self.definitions}
+            for i in instances:
+                if i.definition is not None:
+                    adjacency.setdefault(i.definition, []).append(i)
+            self._instance_index = (instances, positions, adjacency)
+        return self._instance_index
+
+    def invalidate_instances(self):
+        self._instance_index = None
+
+    def get_definition_instances(self, definition):
+        _, _, adjacency = self.instance_index
+        return adjacency.get(definition, [])
+
+    def move_instance(self, instance, old_definition, new_definition):
+        if getattr(self, '_instance_index', None) is None:
+            return
+        if old_definition is new_definition:
+            return
+        _, positions, adjacency = self._instance_index
+        if instance not in positions:
+            return
+        if old_definition is not None:
+            adjacency[old_definition].remove(instance)
+        if new_definition is not None:
+            instances = adjacency.setdefault(new_definition, [])
+            position = positions[instance]
+            for n, i in enumerate(instances):
+                if positions[i] > position:
+                    instances.insert(n, instance)
+                    break
+            else:
+                instances.append(instance)
+
     @property
     def instances(self):
-        entities = []
-        for key in sorted(self.spawn_groups):
-            entities += self.spawn_groups[key]
-        return entities
+        return self.instance_index[0]
 
     @property
     def entities(self):
@@ -1751,6 +2315,11 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
     def get_compressed(self):
         if hasattr(self, '_cached_compressed'):
             return self._cached_compressed
+        if hasattr(self, '_compressed_location'):
+            address, length = self._compressed_location
+            f = get_open_file(get_outfile())
+            f.seek(address)
+            return f.read(length)
         start = self.data_pointer
         try:
             finish = self.get(self.index+1).data_pointer
@@ -1789,67 +2358,87 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
     def get_entities(self):
         assert not self.is_rom_split
         assert self.is_room
-        if hasattr(self, 'footer'):
+        # Checked directly, since the entity properties decode on access
+        if self.is_decoded:
             return self.entities
 
         self.footer = None
         data = self.get_decompressed()
         if data is None:
             return None
+        data = memoryview(data)
 
         definition_segment = data[:self.instance_offset]
         instance_segment = data[self.instance_offset:self.footer_offset]
-        self.footer = data[self.footer_offset:self.ending_offset]
+        self.footer = bytes(data[self.footer_offset:self.ending_offset])
         group_data = data[self.ending_offset:]
         assert len(data) >= self.ending_offset
 
+        # Records are sliced from the memoryview by offset, so each entity
+        # gets a view of its bytes without re-copying the rest of the file.
+        # Indexes are assigned in file order, so they are unique without a
+        # duplicate check; the null terminator of each spawn group takes the
+        # next index without consuming it.
         self.spawn_groups = {}
         self.definitions = []
-        while definition_segment:
+        self._decoded_entities = []
+        length = self.EntityDefinition.DATA_LENGTH
+        for offset in range(0, len(definition_segment), length):
             entity = self.EntityDefinition(
-                definition_segment[:self.EntityDefinition.DATA_LENGTH], self)
-            definition_segment = \
-                definition_segment[self.EntityDefinition.DATA_LENGTH:]
+                definition_segment[offset:offset+length], self,
+                index=len(self.definitions), check_index=False)
+            self._decoded_entities.append(entity)
             self.definitions.append(entity)
+            MapMetaObject.indexed_definitions.add(entity)
+        next_index = len(self.definitions)
 
         group_offsets = {(-1, -1, -1): 0}
-        for x in range(self.groups_x):
-            for z in range(self.groups_z):
-                for y in range(self.groups_y):
-                    group, group_data = group_data[:4], group_data[4:]
-                    if group == b'\x00\x00\x00\x00':
-                        continue
-                    assert group[:2] == b'\x08\x00'
-                    offset = int.from_bytes(group[2:], byteorder='big')
-                    group_offsets[(x, z, y)] = offset - self.instance_offset
+        keys = list(product(range(self.groups_x), range(self.groups_z),
+                            range(self.groups_y)))
+        group_length = len(keys) * self.GROUP_STRUCT.size
+        assert len(group_data) >= group_length
+        group_data = group_data[:group_length]
+        for key, (flag, offset) in zip(
+                keys, self.GROUP_STRUCT.iter_unpack(group_data)):
+            if flag == offset == 0:
+                continue
+            assert flag == 0x800
+            group_offsets[key] = offset - self.instance_offset
 
+        length = self.EntityInstance.DATA_LENGTH
         for key in group_offsets:
             offset = group_offsets[key]
-            data = instance_segment[offset:]
             spawn_group = []
             while True:
-                edata, data = (data[:self.EntityInstance.DATA_LENGTH],
-                               data[self.EntityInstance.DATA_LENGTH:])
-                entity = self.EntityInstance(edata, self)
+                edata = instance_segment[offset:offset+length]
+                offset += length
+                entity = self.EntityInstance(edata, self, index=next_index,
+                                             check_index=False)
+                self._decoded_entities.append(entity)
                 if entity.is_null:
                     break
+                next_index += 1
                 spawn_group.append(entity)
                 self.spawn_groups[key] = spawn_group
+        self.invalidate_instances()
+        self.mark_changed()
         return self.entities
 
     def get_instance_data(self):
         group_offsets = {}
-        data = b''
+        chunks = []
+        length = 0
+        terminator = b'\x00' * self.EntityInstance.DATA_LENGTH
         for key in sorted(self.spawn_groups):
             if not self.spawn_groups[key]:
                 continue
-            group_offsets[key] = len(data)
-            for e in self.spawn_groups[key]:
-                data += e.data
-            data += b'\x00' * self.EntityInstance.DATA_LENGTH
-        if not data:
-            data = b'\x00' * self.EntityInstance.DATA_LENGTH
-        return data, group_offsets
+            group_offsets[key] = length
+            chunks.extend(e.data for e in self.spawn_groups[key])
+            chunks.append(terminator)
+            length += (len(self.spawn_groups[key]) + 1) * len(terminator)
+        if not chunks:
+            chunks.append(terminator)
+        return b''.join(chunks), group_offsets
 
     def add_new_definition(self, data):
         definition_indexes = {d.index for d in self.definitions}
@@ -1862,6 +2451,9 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
         assert new_index not in instance_indexes
         definition = self.EntityDefinition(data, self, index=new_index)
         self.definitions.append(definition)
+        MapMetaObject.indexed_definitions.add(definition)
+        self.invalidate_instances()
+        self.mark_changed()
         assert self.entities.index(definition) == definition.index
         return definition
 
@@ -1900,11 +2492,40 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
             self.definitions.append(new_entity)
             self.definitions = sorted(self.definitions, key=lambda e: e.index)
         else:
-            if spawn_group not in self.spawn_groups:
-                self.spawn_groups[spawn_group] = []
-            self.spawn_groups[spawn_group].append(new_entity)
+            self.add_instance(new_entity, spawn_group)
         return new_entity
 
+    def remove_definitions(self, definitions):
+        # Removes the definitions and all of their instances, then renumbers
+        # the remaining definitions and their instances in a single pass.
+        removed = set(definitions)
+        if not removed:
+            return
+        assert all(d.parent is self for d in removed)
+        assert all(d in self.definitions for d in removed)
+        associations = [(d, d.instances) for d in self.definitions
+                        if d not in removed]
+        removed_instances = {i for d in removed
+                             for i in self.get_definition_instances(d)}
+        for group, instances in self.spawn_groups.items():
+            self.spawn_groups[group] = [i for i in instances
+                                        if i not in removed_instances]
+        self.definitions = [d for (d, _) in associations]
+        for n, (definition, instances) in enumerate(associations):
+            definition.index = n
+            for i in instances:
+                i.set_main_property(definition.index)
+        entities = set(self.entities)
+        assert not removed & entities
+        assert not removed_instances & entities
+
+    def add_instance(self, instance, spawn_group=(-1, -1, -1)):
+        if spawn_group not in self.spawn_groups:
+            self.spawn_groups[spawn_group] = []
+        self.spawn_groups[spawn_group].append(instance)
+        self.invalidate_instances()
+        self.mark_changed()
+
     def deallocate(self):
         start = self._deallocation_start
         finish = self._deallocation_finish
@@ -1956,8 +2577,10 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
     def force_write(self):
         assert self.is_compressed
         compressed = recompress(self.data)
-        assert len(compressed) <= len(self._cached_compressed)
-        while len(compressed) < len(self._cached_compressed):
+        unpadded_length = len(compressed)
+        old_length = len(self.get_compressed())
+        assert len(compressed) <= old_length
+        while len(compressed) < old_length:
             compressed += b'\xff'
         address = self.reference_pointer & 0x7fffffff
         self.force_allocate(address, len(compressed))
@@ -1965,14 +2588,77 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
         f.seek(address)
         f.write(compressed)
         self.relocated = True
+        self.release_buffers(address, unpadded_length)
+
+    def release_buffers(self, address, length):
+        # Once written, the compressed file can be read back from the output
+        # file, and an unmodified file can be decompressed again from there.
+        # The length excludes padding, so reads return the bytes as before.
+        if hasattr(self, '_cached_decompressed') and not self.data_has_changed:
+            self.detach_entity_views()
+            del(self._cached_decompressed)
+        for attribute in ('_cached_compressed', '_cached_data',
+                          '_changed_check'):
+            if attribute in self.__dict__:
+                delattr(self, attribute)
+        self._compressed_location = (address, length)
+
+    def detach_entity_views(self):
+        # Vanilla entity data are views into the decompressed buffer. A bytes
+        # copy is smaller than the memoryview object itself, and lets the
+        # buffer be freed.
+        for e in self.__dict__.pop('_decoded_entities', ()):
+            if isinstance(e.old_data, memoryview):
+                e.old_data = bytes(e.old_data)
+
+    @classmethod
+    def memory_report(self, limit=10):
+        CACHES = [('compressed', '_cached_compressed'),
+                  ('decompressed', '_cached_decompressed'),
+                  ('data', '_data'),
+                  ('serialized', '_cached_data')]
+        totals = Counter()
+        by_file = Counter()
+        counted = set()
+        for mmo in MapMetaObject.every:
+            for name, attribute in CACHES:
+                value = mmo.__dict__.get(attribute)
+                if isinstance(value, (bytes, bytearray)):
+                    totals[name] += len(value)
+                    by_file[mmo.file_index] += len(value)
+                    counted.add(id(value))
+        for mmo in MapMetaObject.every:
+            if not mmo.is_decoded:
+                continue
+            for e in mmo.entities:
+                size = len(e.data)
+                if isinstance(e.old_data, memoryview):
+                    # Count any buffer that is only kept alive by views
+                    buffer = e.old_data.obj
+                    if id(buffer) not in counted:
+                        counted.add(id(buffer))
+                        totals['views'] += len(buffer)
+                        by_file[mmo.file_index] += len(buffer)
+                else:
+                    size += len(e.old_data)
+                totals['entities'] += size
+                by_file[mmo.file_index] += size
+        lines = ['MEMORY HELD BY FILE CACHES']
+        for name, size in sorted(totals.items()):
+            lines.append(f'  {name:12} {size:>10}')
+        lines.append(f'  {"total":12} {sum(totals.values()):>10}')
+        for file_index, size in by_file.most_common(limit):
+            lines.append(f'  FILE {file_index:0>3x}     {size:>10}')
+        return '\n'.join(lines)
 
     def compress_and_write(self):
         if self.file_index in self.FORCE_OLD_POINTER:
             if not self.data_has_changed:
-                assert self.get_compressed() == self._cached_compressed
-                self.force_allocate(self.reference_pointer & 0x7fffffff,
-                                    len(self._cached_compressed))
+                address = self.reference_pointer & 0x7fffffff
+                length = len(self.get_compressed())
+                self.force_allocate(address, length)
                 self.relocated = True
+                self.release_buffers(address, length)
                 return
             else:
                 #if not self.is_room:
@@ -1982,7 +2668,7 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
 
         if self.data_has_changed:
             old_length = self.metasize.metasize
-            assert old_length == len(self._cached_decompressed)
+            assert old_length == len(self.get_decompressed())
             new_length = len(self.data)
             while new_length % 0x4:
                 new_length += 1
@@ -1995,6 +2681,7 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
             data = self.get_compressed()
         else:
             data = self.get_decompressed()
+        unpadded_length = len(data)
 
         if self.file_index == MapCategoryData.ROOM_DATA_INDEX:
             old_length = len(self.get_compressed())
@@ -2007,6 +2694,7 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
 
         if self.is_rom_split:
             data = b''
+            unpadded_length = 0
         address = self.allocate(len(data))
         f = get_open_file(get_outfile())
         f.seek(address)
@@ -2014,6 +2702,7 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
         new_pointer = (self.reference_pointer & 0x80000000) | address
         self.reference_pointer = new_pointer
         self.relocated = True
+        self.release_buffers(address, unpadded_length)
 
     def validate_budget(self):
         # Some actors depend on files of other actors (i.e. pink robot spawner)
@@ -2028,16 +2717,17 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
         for index in sorted(maybe_cut - used_files):
             if VERBOSE or DEBUG_MODE:
                 print(f'REMOVING {index:0>3x} from {self.warp_index:0>3x}.')
-            for d in self.definitions:
-                if self.ENTITY_FILES[d.actor_id] == index:
-                    if VERBOSE or DEBUG_MODE:
-                        print(f'REMOVING {d.signature} from '
-                              f'{self.warp_index:0>3x}.')
-                    d.remove()
+            to_remove = [d for d in self.definitions
+                         if self.ENTITY_FILES[d.actor_id] == index]
+            if VERBOSE or DEBUG_MODE:
+                for d in to_remove:
+                    print(f'REMOVING {d.signature} from '
+                          f'{self.warp_index:0>3x}.')
+            self.remove_definitions(to_remove)
             if index in self.old_loading_files and \
                     index not in self.old_instance_loading_files:
                 continue
-            self.loading_files.remove(index)
+            self.remove_loading_file(index)
 
     def validate_entity_files(self):
         for e in self.instances:
@@ -2053,7 +2743,7 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
                 if VERBOSE or DEBUG_MODE:
                     print(f'Warning: Entity {e.definition.signature} requires '
                           f'file {file_index:0>3x}; adding automatically.')
-                self.loading_files.append(file_index)
+                self.add_loading_file(file_index)
             if actor_id in self.EXTRA_DEPENDENCIES:
                 for file_index in self.EXTRA_DEPENDENCIES[actor_id]:
                     if file_index not in self.loading_files:
@@ -2061,7 +2751,7 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
                             print(f'Warning: Entity {e.definition.signature} '
                                   f'requires extra file {file_index:0>3x}; '
                                   f'adding automatically.')
-                        self.loading_files.append(file_index)
+                        self.add_loading_file(file_index)
         if self.warp_index == self.MUSASHI_IGA_TUNNEL \
                 and get_global_label() == 'MN64_EN':
             assert 0x20 in self.loading_files
@@ -2089,28 +2779,41 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
                 return True
         return False
 
+    @property
+    def instance_positions(self):
+        # Signed x/y/z of every instance, refreshed whenever the room changes.
+        if getattr(self, '_instance_positions', (None,))[0] \
+                != self.modification_count:
+            positions = {i: i.position for i in self.instances}
+            self._instance_positions = (self.modification_count, positions)
+        return self._instance_positions[1]
+
+    def get_position(self, instance):
+        positions = self.instance_positions
+        if instance in positions:
+            return positions[instance]
+        return instance.position
+
+    def get_instances_by_position(self, instances):
+        by_position = defaultdict(list)
+        for i in instances:
+            by_position[self.get_position(i)].append(i)
+        return by_position
+
+    def get_nearest_instance(self, position, candidates, key=None):
+        # Candidates are compared by squared distance, then by key.
+        if key is None:
+            key = lambda c: 0
+        return min(candidates, key=lambda c: (
+            squared_distance(position, self.get_position(c)), key(c)))
+
     def get_nearest_exit(self, x, y, z):
-        def distance(a, b):
-            x1, y1, z1 = a
-            x2, y2, z2 = b
-            return (((x1-x2)**2) + ((y1-y2)**2) + ((z1-z2)**2)) ** 0.5
-
-        x1 = x if x < 0x8000 else x - 0x10000
-        y1 = y if y < 0x8000 else y - 0x10000
-        z1 = z if z < 0x8000 else z - 0x10000
-        coords = {}
-        for door in self.exits:
-            x2 = door.get_property_value('x')
-            y2 = door.get_property_value('y')
-            z2 = door.get_property_value('z')
-            x2 = x2 if x2 < 0x8000 else x2 - 0x10000
-            y2 = y2 if y2 < 0x8000 else y2 - 0x10000
-            z2 = z2 if z2 < 0x8000 else z2 - 0x10000
-            coords[x2, y2, z2] = door
-
-        sorted_coords = sorted(
-                coords, key=lambda c: (distance((x1, y1, z1), c), c))
-        return coords[sorted_coords[0]]
+        position = (to_signed16(x), to_signed16(y), to_signed16(z))
+        # Exits sharing a position resolve to the last one listed.
+        exits_by_position = self.get_instances_by_position(self.exits)
+        nearest = min(exits_by_position, key=lambda c: (
+            squared_distance(position, c), c))
+        return exits_by_position[nearest][-1]
 
     def preprocess(self):
         self.get_compressed()
@@ -2118,13 +2821,44 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
             assert self.data_pointer >= self.get(self.index-1).data_pointer
 
         if self.is_room:
-            self.get_entities()
-            self.old_instance_loading_files = set()
-            for i in self.instances:
-                loading_file = self.ENTITY_FILES[i.definition.actor_id]
-                if loading_file != 0:
-                    self.old_instance_loading_files.add(loading_file)
-            assert not self.data_has_changed
+            # Entities are decoded on first access; see decode_entities.
+            self.unmodified_count = self.modification_count
+
+    @property
+    def is_decoded(self):
+        return '_definitions' in self.__dict__
+
+    def decode_entities(self):
+        assert self.is_room
+        if self.get_entities() is None:
+            raise Exception(f'Room {self.warp_index:0>3x} has no data.')
+        self._old_definitions = tuple(self.definitions)
+        self.old_instance_loading_files = set()
+        for i in self.instances:
+            loading_file = self.ENTITY_FILES[i.definition.actor_id]
+            if loading_file != 0:
+                self.old_instance_loading_files.add(loading_file)
+        # Decoding and re-encoding an untouched room must give back its
+        # original data.
+        if self.data_has_changed:
+            raise Exception(f'Room {self.warp_index:0>3x} does not round '
+                            f'trip through decoding and encoding.')
+        self.unmodified_count = self.modification_count
+
+    @classmethod
+    def decode_all_rooms(self):
+        if MapMetaObject.all_rooms_decoded:
+            return
+        for mmo in MapMetaObject.every:
+            if mmo.is_room and not mmo.is_decoded:
+                mmo.decode_entities()
+        MapMetaObject.all_rooms_decoded = True
+
+    @property
+    def old_definitions(self):
+        if not self.is_decoded:
+            self.decode_entities()
+        return self._old_definitions
 
     def preclean(self):
         if self.file_index >= MapCategoryData.ROOM_DATA_INDEX:
@@ -2174,9 +2908,12 @@ class MapMetaObject(TableObject, ConvertPointerMixin):
     def preprocess_all(cls):
         MapMetaObject.free_space = [(addresses.free_space_start,
                                      addresses.free_space_end)]
+        cls.invalidate_room_registry()
         for mmo in MapMetaObject.every:
             mmo.warp_index = None
         cls.read_loading_files()
+        MapMetaObject._actor_catalog = None
+        MapMetaObject.all_rooms_decoded = False
         super().preprocess_all()
 
     @classmethod
@@ -2233,6 +2970,11 @@ class MapCategoryData(ConvertPointerMixin):
     DATA_LENGTHS = [
         20, 8, 8, 4, 4, 2, 2,
         ]
+    WARP_CATEGORIES = [None] * max(b for (a, b) in CATEGORY_RANGES)
+    for __n, (__a, __b) in enumerate(CATEGORY_RANGES):
+        for __warp_index in range(__a, __b):
+            WARP_CATEGORIES[__warp_index] = (__n, __warp_index - __a)
+    WARP_CATEGORIES = tuple(WARP_CATEGORIES)
 
     STRUCTURE = {
         'graphics1':        (0, (0, 8)),
@@ -2251,12 +2993,19 @@ class MapCategoryData(ConvertPointerMixin):
         }
 
     datas_by_warp_index = {}
+    _every = None
+    _section_bases = None
 
     def __init__(self, warp_index):
         self.warp_index = warp_index
         self.read_attributes()
         assert self.special_idle_animations
 
+    def __setattr__(self, attribute, value):
+        super().__setattr__(attribute, value)
+        if attribute in self.STRUCTURE and hasattr(self, 'dirty'):
+            self.dirty.add(attribute)
+
     @classproperty
     def VIRTUAL_RAM_OFFSET(self):
         # Location in RAM where file 00b is
@@ -2268,8 +3017,11 @@ class MapCategoryData(ConvertPointerMixin):
 
     @classproperty
     def every(self):
-        return [self.get_by_warp_index(mmo.warp_index)
-                for mmo in MapMetaObject.sorted_rooms]
+        if MapCategoryData._every is None:
+            MapCategoryData._every = tuple(
+                self.get_by_warp_index(mmo.warp_index)
+                for mmo in MapMetaObject.sorted_rooms)
+        return MapCategoryData._every
 
     @classmethod
     def get_by_warp_index(self, warp_index):
@@ -2283,14 +3035,14 @@ class MapCategoryData(ConvertPointerMixin):
 
     @property
     def has_changed(self):
-        for attribute in self.old_data:
+        for attribute in self.dirty:
             if self.old_data[attribute] != getattr(self, attribute):
                 return True
         return False
 
-    def read_attribute(self, section, indexes):
+    def read_attribute(self, rows, section, indexes):
         a, b = indexes
-        data = MapCategoryData.get_data(self.warp_index, section)[a:b]
+        data = rows[section][a:b]
         if len(data) > 4:
             return data
         return int.from_bytes(data, byteorder='big')
@@ -2298,20 +3050,22 @@ class MapCategoryData(ConvertPointerMixin):
     def read_attributes(self):
         if not hasattr(self, 'old_data'):
             self.old_data = {}
+        rows = MapCategoryData.get_rows(self.warp_index)
         for attribute, directions in self.STRUCTURE.items():
             if isinstance(directions, list):
                 setattr(self, attribute,
-                        [self.read_attribute(section, indexes)
+                        [self.read_attribute(rows, section, indexes)
                          for (section, indexes) in directions])
             else:
                 section, indexes = directions
                 setattr(self, attribute,
-                        self.read_attribute(section, indexes))
+                        self.read_attribute(rows, section, indexes))
             if attribute not in self.old_data:
                 value = getattr(self, attribute)
                 if isinstance(value, list):
                     value = list(value)
                 self.old_data[attribute] = value
+        self.dirty = set()
 
     def get_pretty_attribute(self, attribute):
         directions = self.STRUCTURE[attribute]
@@ -2330,24 +3084,30 @@ class MapCategoryData(ConvertPointerMixin):
                 result.append(hexify(v))
         return ','.join(result)
 
-    def save_attribute(self, section, indexes, value):
+    def save_attribute(self, rows, section, indexes, value):
         a, b = indexes
         if isinstance(value, int):
             value = value.to_bytes(length=(b-a), byteorder='big')
-        data = MapCategoryData.get_data(self.warp_index, section)
+        data = rows[section]
         newdata = data[:a] + value + data[b:]
         room_category, _ = self.convert_warp_to_category(self.warp_index)
         if data != newdata and section == 6 and room_category in [0, 3]:
             assert not 0x5a <= self.warp_index < 0x190
             raise Exception(f'Room {self.warp_index:0>3x} cannot change '
                             f'misc data in section {section}.')
-
-        MapCategoryData.save_data(self.warp_index, section, newdata)
+        rows[section] = newdata
 
     def save_attributes(self):
         assert not hasattr(self, '_saved')
         self._saved = True
+        self._saved_rows = {}
+        if not self.has_changed:
+            return
+        old_rows = MapCategoryData.get_rows(self.warp_index)
+        rows = list(old_rows)
         for attribute, directions in self.STRUCTURE.items():
+            if attribute not in self.dirty:
+                continue
             value = getattr(self, attribute)
             if value == self.old_data[attribute]:
                 continue
@@ -2355,19 +3115,23 @@ class MapCategoryData(ConvertPointerMixin):
                 assert len(directions) == len(value)
                 for (d, v) in zip(directions, value):
                     section, indexes = d
-                    self.save_attribute(section, indexes, v)
+                    self.save_attribute(rows, section, indexes, v)
             else:
                 section, indexes = directions
-                self.save_attribute(section, indexes, value)
+                self.save_attribute(rows, section, indexes, value)
+        self._saved_rows = {section: data for (section, data)
+                            in enumerate(rows) if data != old_rows[section]}
+        MapCategoryData.save_rows(self.warp_index, self._saved_rows)
 
     def verify_attributes(self):
         assert hasattr(self, '_saved')
-        verify = {attribute: getattr(self, attribute)
-                  for attribute in self.STRUCTURE}
-        self.read_attributes()
-        for attribute in self.STRUCTURE:
-            if verify[attribute] != getattr(self, attribute):
-                raise Exception(error)
+        if not self._saved_rows:
+            return
+        rows = MapCategoryData.get_rows(self.warp_index)
+        for section, data in self._saved_rows.items():
+            if rows[section] != data:
+                raise Exception(f'Room {self.warp_index:0>3x} misc data in '
+                                f'section {section} was not saved.')
 
     def randomize(self):
         room_category, _ = self.convert_warp_to_category(self.warp_index)
@@ -2394,8 +3158,24 @@ class MapCategoryData(ConvertPointerMixin):
 
         mmo = MapMetaObject.get_by_file_index(MapCategoryData.ROOM_DATA_INDEX)
         MapCategoryData._data = BytesIO(mmo.get_decompressed())
+        MapCategoryData._section_bases = None
         return MapCategoryData.data
 
+    @classproperty
+    def section_bases(self):
+        # Start of each section's table, by section and then room category
+        if MapCategoryData._section_bases is None:
+            bases = []
+            with self.data.getbuffer() as buf:
+                for pointer_pointer in self.POINTER_POINTERS:
+                    pointer = self.convert_pointer(pointer_pointer)
+                    bases.append(tuple(
+                        self.convert_pointer(bytes(buf[p:p+4]))
+                        for p in range(pointer, pointer + (
+                            len(self.CATEGORY_RANGES) * 4), 4)))
+            MapCategoryData._section_bases = tuple(bases)
+        return MapCategoryData._section_bases
+
     @clached_property
     def special_idle_animations(self):
         self.data.seek(self.convert_pointer(addresses.file00b_idle_offset))
@@ -2411,43 +3191,54 @@ class MapCategoryData(ConvertPointerMixin):
 
     @classmethod
     def convert_warp_to_category(self, warp_index):
-        for n, (a, b) in enumerate(self.CATEGORY_RANGES):
-            if a <= warp_index < b:
-                room_category = n
-                category_index = warp_index - a
-                break
-        else:
-            raise Exception(f'Warp index {warp_index:0>3x} has no category.')
-        return room_category, category_index
+        if 0 <= warp_index < len(self.WARP_CATEGORIES):
+            result = self.WARP_CATEGORIES[warp_index]
+            if result is not None:
+                return result
+        raise Exception(f'Warp index {warp_index:0>3x} has no category.')
 
     @classmethod
     def get_data_address(self, warp_index, section):
         room_category, category_index = \
                 self.convert_warp_to_category(warp_index)
-
-        mmo = MapMetaObject.get_by_file_index(self.ROOM_DATA_INDEX)
-        pointer_pointer = self.POINTER_POINTERS[section]
-        pointer = self.convert_pointer(pointer_pointer) + (room_category*4)
-        self.data.seek(pointer)
-        pointer = self.convert_pointer(self.data.read(4))
-        data_length = self.DATA_LENGTHS[section]
-        pointer += category_index * data_length
-        return pointer
+        return (self.section_bases[section][room_category]
+                + category_index * self.DATA_LENGTHS[section])
 
     @classmethod
     def get_data(self, warp_index, section):
         pointer = self.get_data_address(warp_index, section)
-        self.data.seek(pointer)
-        data_length = self.DATA_LENGTHS[section]
-        data = self.data.read(data_length)
-        return data
+        with self.data.getbuffer() as buf:
+            return bytes(buf[pointer:pointer+self.DATA_LENGTHS[section]])
 
     @classmethod
     def save_data(self, warp_index, section, data):
-        assert len(data) == self.DATA_LENGTHS[section]
-        pointer = self.get_data_address(warp_index, section)
-        self.data.seek(pointer)
-        self.data.write(data)
+        self.save_rows(warp_index, {section: data})
+
+    @classmethod
+    def get_rows(self, warp_index):
+        # One row of data per section for this room
+        room_category, category_index = \
+                self.convert_warp_to_category(warp_index)
+        rows = []
+        with self.data.getbuffer() as buf:
+            for bases, length in zip(self.section_bases, self.DATA_LENGTHS):
+                pointer = bases[room_category] + (category_index * length)
+                rows.append(bytes(buf[pointer:pointer+length]))
+        return rows
+
+    @classmethod
+    def save_rows(self, warp_index, rows):
+        if isinstance(rows, list):
+            rows = dict(enumerate(rows))
+        room_category, category_index = \
+                self.convert_warp_to_category(warp_index)
+        with self.data.getbuffer() as buf:
+            for section, data in sorted(rows.items()):
+                length = self.DATA_LENGTHS[section]
+                assert len(data) == length
+                pointer = self.section_bases[section][room_category] + (
+                    category_index * length)
+                buf[pointer:pointer+length] = data
 
     @classmethod
     def full_preclean(self):
@@ -2527,15 +3318,18 @@ class MessageFileObject(TableObject):
 
     def set_file_index(self, value):
         self.file_index_str = value.to_bytes(length=2, byteorder='big')
+        MessagePointerObject._messages_by_file = None
 
     def del_file_index(self):
         self.file_index_str = self.old_data['file_index_str']
+        MessagePointerObject._messages_by_file = None
 
     file_index = property(get_file_index, set_file_index, del_file_index)
 
 
 class MessagePointerObject(TableObject):
     parsers = {0: None}
+    _messages_by_file = None
 
     def __repr__(self):
         lines = []
@@ -2601,21 +3395,34 @@ class MessagePointerObject(TableObject):
         self.scripts
         return MessagePointerObject.parsers[self.file_index]
 
+    @property
+    def loaded_parser(self):
+        # The parser for this message's file, only if something has used it
+        return MessagePointerObject.parsers.get(self.file_index)
+
+    @classproperty
+    def messages_by_file(self):
+        if MessagePointerObject._messages_by_file is None:
+            messages_by_file = defaultdict(list)
+            for mpo in MessagePointerObject.every:
+                messages_by_file[mpo.file_index].append(mpo)
+            MessagePointerObject._messages_by_file = dict(messages_by_file)
+        return MessagePointerObject._messages_by_file
+
     def get_npcs(self):
-        npcs = []
-        for mmo in MapMetaObject.every:
-            if not mmo.is_room:
-                continue
-            npcs += [d for d in mmo.definitions
-                     if 'message' in d.structure
-                     and d.get_property_value('message') == self.index]
-        return npcs
+        return MapMetaObject.indexed_definitions.find(message=self.index)
 
     def get_message(self):
         if self.file_index not in MessagePointerObject.parsers:
             data = MapMetaObject.get(self.file_index-1).get_decompressed()
             parser = GoemonParser(self.PARSER_CONFIG, data, set())
             parser.file_index = self.file_index
+            parser.updated = False
+            # Every message in the file is read up front, so recompiling the
+            # file never drops scripts that were not accessed individually.
+            for mpo in MessagePointerObject.messages_by_file[self.file_index]:
+                parser.add_pointer(mpo.message_pointer, script=True)
+            parser.read_scripts()
             MessagePointerObject.parsers[self.file_index] = parser
         parser = MessagePointerObject.parsers[self.file_index]
         if parser is None:
@@ -2795,27 +3602,29 @@ class MessagePointerObject(TableObject):
             mpo.parser.updated = True
 
     def preprocess(self):
-        self.scripts
-        if self.parser and not hasattr(self.parser, 'updated'):
-            self.parser.updated = False
+        # Scripts are parsed per file on first access; see get_message.
+        return
 
     def preclean(self):
         self.old_message_pointer = self.message_pointer
-        if self.parser and self.parser.updated:
+        parser = self.loaded_parser
+        if parser and parser.updated:
             assert self.misc & 8
             mmo = MapMetaObject.get(self.file_index-1)
-            mmo._data = self.parser.to_bytecode()
-            self.parser.updated = False
+            mmo._data = parser.to_bytecode()
+            parser.updated = False
 
     def cleanup(self):
-        if self.parser is None:
+        # Files whose parser was never built cannot have been recompiled
+        parser = self.loaded_parser
+        if parser is None:
             return
         mmo = MapMetaObject.get(self.file_index-1)
         if mmo.data_has_changed:
             assert self.misc & 8
             script_pointer = self.message_pointer | \
-                    self.parser.config['virtual_address']
-            script = self.parser.scripts[script_pointer]
+                    parser.config['virtual_address']
+            script = parser.scripts[script_pointer]
             self.message_pointer = script.pointer.repointer
 
     @classmethod
@@ -2974,12 +3783,10 @@ def setup_dragon_warps(dr):
     mpo.root.prepend_instruction(f'04:{addresses.have_oedo_town_warp:x}')
     mpo.parser.updated = True
 
-    for mmo in MapMetaObject.every:
-        if not mmo.is_room:
-            continue
-        for d in list(mmo.definitions):
-            if d.actor_id in (0x2ee, 0x33d, 0x34e):
-                d.remove()
+    to_remove = MapMetaObject.indexed_definitions.find(
+            actor_ids=(0x2ee, 0x33d, 0x34e))
+    for mmo in dict.fromkeys(d.parent for d in to_remove):
+        mmo.remove_definitions([d for d in to_remove if d.parent is mmo])
 
     patch_file('patch_dragon_atlas_011.txt', DRAGON_ATLAS_INDEX)
 
@@ -3014,7 +3821,7 @@ def setup_dragon_warps(dr):
                     b'\x00' * 0x14, room_exit.parent)
             instance.set_main_property(definition.index)
             instance.clean()
-            room_exit.parent.spawn_groups[(-1,-1,-1)].append(instance)
+            room_exit.parent.add_instance(instance)
 
 
 def randomize_enemies():
@@ -3040,19 +3847,33 @@ def randomize_enemies():
     file_counts = sorted(file_counts)
     enemy_files = sorted(enemy_files)
 
+    # Candidate pools per loading file, kept in all_enemies order.
+    enemy_order = {e: n for (n, e) in enumerate(all_enemies)}
+    enemy_pools = defaultdict(list)
+    for e in all_enemies:
+        file_index = MapMetaObject.ENTITY_FILES[e.old_definition.old_actor_id]
+        enemy_pools[file_index].append(e)
+
+    # Files loaded by choosing from each pool, including extra dependencies
+    file_closures = {}
+    for file_index, pool in enemy_pools.items():
+        closure = {file_index}
+        for e in pool:
+            closure |= MapMetaObject.EXTRA_DEPENDENCIES.get(
+                e.old_definition.old_actor_id, set())
+        file_closures[file_index] = frozenset(closure)
+    file_costs = {f: MetaSizeObject.get_by_file_index(f).effective_metasize
+                  for closure in file_closures.values() for f in closure}
+
     relative_z_data = defaultdict(list)
     for e in all_enemies:
         if not e.parent.exits:
             continue
-        exits = sorted(e.parent.exits, key=lambda x: (e.get_distance(x),
-                                                      x.signature))
-        x = exits[0]
-        ez = e.get_property_value('z')
-        xz = x.get_property_value('z')
-        if ez >= 0x8000:
-            ez = (0x10000-ez) * -1
-        if xz >= 0x8000:
-            xz = (0x10000-xz) * -1
+        mmo = e.parent
+        x = mmo.get_nearest_instance(mmo.get_position(e), mmo.exits,
+                                     key=lambda x: x.signature)
+        ez = mmo.get_position(e)[2]
+        xz = mmo.get_position(x)[2]
         relative_z = ez - xz
         relative_z_data[e.definition.actor_id].append(relative_z)
 
@@ -3077,14 +3898,30 @@ def randomize_enemies():
                      for e in mmo.enemies}
         candidates = [n for n in file_counts if abs(n-len(old_files)) <= 1]
         new_file_count = random.choice(candidates)
+        loaded = set(mmo.loading_files) - mmo.cuttable_enemy_files
+        used = mmo.base_budget
         new_files = set()
         while len(new_files) < new_file_count:
-            new_files.add(random.choice(enemy_files))
+            extra_costs = {f: sum(file_costs[g]
+                                  for g in file_closures[f] - loaded)
+                           for f in file_closures if f not in new_files}
+            feasible = [f for f in enemy_files if f in extra_costs and
+                        used + extra_costs[f] <= mmo.total_budget]
+            if not feasible:
+                break
+            chosen = random.choice(feasible)
+            new_files.add(chosen)
+            loaded |= file_closures[chosen]
+            used += extra_costs[chosen]
+        if not new_files:
+            # No enemy file fits the budget, so keep the vanilla enemies
+            if VERBOSE or DEBUG_MODE:
+                print(f'Keeping vanilla enemies in {mmo.warp_index:0>3x}; '
+                      f'no enemy files fit its memory budget.')
+            continue
         new_files = sorted(new_files)
-        enemy_candidates = [
-                e for e in all_enemies if
-                MapMetaObject.ENTITY_FILES[e.old_definition.old_actor_id]
-                in new_files]
+        enemy_candidates = list(merge(*[enemy_pools[f] for f in new_files],
+                                      key=enemy_order.__getitem__))
         enemy_definitions = [d for d in mmo.definitions if d.is_enemy]
         for enemy_def in enemy_definitions:
             chosen = random.choice(enemy_candidates)
@@ -3100,9 +3937,9 @@ def randomize_enemies():
         for d in mmo.definitions:
             if not d.is_enemy:
                 continue
-            if d.data in datas:
+            if bytes(d.data) in datas:
                 d.data = b'\x00' * 0x10
-            datas.add(d.data)
+            datas.add(bytes(d.data))
         enemy_definitions = [d for d in mmo.definitions if d.is_enemy]
         lowest_z = min(m.get_property_value('z') for m in to_reassign)
         reassigned = []
@@ -3134,13 +3971,7 @@ def randomize_enemies():
                 z = max(z, lowest_z)
                 m.set_property('z', z)
             reassigned.append(m)
-        while True:
-            for d in mmo.definitions:
-                if d.is_null:
-                    d.remove()
-                    break
-            else:
-                break
+        mmo.remove_definitions([d for d in mmo.definitions if d.is_null])
 
 
 def randomize_doors():
@@ -3356,6 +4187,7 @@ def randomize_doors():
             copy_to.remove()
 
     # Clear unused exits
+    to_remove = []
     for n in sorted(dr.connectable):
         if n.label in preset_connections:
             continue
@@ -3370,8 +4202,10 @@ def randomize_doors():
             if source.door.is_lock and \
                     source.door.signature != BIZEN_LOCK_LABEL:
                 source.door.become_regular_door()
-            source.door.remove()
-        source.remove()
+            to_remove.append(source.door)
+        to_remove.append(source)
+    for mmo in dict.fromkeys(d.parent for d in to_remove):
+        mmo.remove_definitions([d for d in to_remove if d.parent is mmo])
 
     silver_cats = set()
     gold_cats = set()
@@ -3534,8 +4368,8 @@ def randomize_doors():
         m2key.become_surprise_pack(flag)
         flag = m2key.get_property_value('flag')
 
-    for e in m2key.parent.definitions:
-        if 'flag' in e.structure and e.get_property_value('flag') == old_flag:
+    for e in MapMetaObject.indexed_definitions.find(flag=old_flag):
+        if e.parent is m2key.parent:
             e.set_property('flag', flag)
 
     pickups = set()
@@ -3850,7 +4684,7 @@ def fix_softlockable_rooms(definition_overrides):
     instance.set_property('x', x)
     instance.set_property('y', y)
     instance.set_property('z', z)
-    mmo.spawn_groups[(-1,-1,-1)].append(instance)
+    mmo.add_instance(instance)
     definition_overrides['softlock_091'] = 'start'
 
     mmo = MapMetaObject.get_by_warp_index(0x142)
@@ -3864,7 +4698,7 @@ def fix_softlockable_rooms(definition_overrides):
     instance.set_property('x', x)
     instance.set_property('y', y)
     instance.set_property('z', z)
-    mmo.spawn_groups[(-1,-1,-1)].append(instance)
+    mmo.add_instance(instance)
 
     LONG_LADDER_ID = 0x33c
     definition = mmo.add_new_definition(b'\x00' * 0x10)
@@ -3876,7 +4710,7 @@ def fix_softlockable_rooms(definition_overrides):
     instance.set_property('x', x)
     instance.set_property('y', y)
     instance.set_property('z', z)
-    mmo.spawn_groups[(-1,-1,-1)].append(instance)
+    mmo.add_instance(instance)
     definition_overrides['softlock_142'] = 'start'
 
     return definition_overrides
@@ -3895,9 +4729,9 @@ def fix_missable_events(definition_overrides):
 def add_roommates():
     MONEY_HANDLING_FLAG = 0x82
     NPC_FILES = [0x1a]
-    candidates = {c for c in MapMetaObject.ENTITY_FILES
-                  if MapMetaObject.ENTITY_FILES[c] in NPC_FILES
-                  and c in MapMetaObject.ENTITY_STRUCTURES}
+    catalog = MapMetaObject.actor_catalog
+    candidates = {c for f in NPC_FILES for c in catalog.actor_ids_by_file[f]
+                  if c in MapMetaObject.ENTITY_STRUCTURES}
     mmo = MapMetaObject.get_by_warp_index(0x1d1)
 
     x_values = [0xffe8, 0xfff4, 0, 0xc]
@@ -3914,7 +4748,380 @@ def add_roommates():
         instance.set_property('x', x_values.pop())
         instance.set_property('y', 0xfff0)
         instance.set_property('z', 0xfff0)
-        mmo.spawn_groups[(-1,-1,-1)].append(instance)
+        mmo.add_instance(instance)
+
+
+MODEL_TABLE_OBJECTS = [MetaSizeObject, MapMetaObject, SaveWarpObject,
+                       DragonWarpObject, MessageFileObject,
+                       MessagePointerObject]
+MODEL_CLASS_ATTRIBUTES = ['free_space', 'available_memory_flags',
+                          'loading_data_start', 'loading_data_end',
+                          'loading_routine_start', 'loading_routine_end']
+
+
+def copy_state(value):
+    # Containers are copied so that either side can change them freely.
+    # Everything else, including file buffers, is immutable and shared.
+    if isinstance(value, dict):
+        return {k: copy_state(v) for (k, v) in value.items()}
+    if isinstance(value, (list, set, bytearray)):
+        return type(value)(copy_state(v) for v in value)
+    return value
+
+
+def snapshot_model():
+    '''
+    Capture the preprocessed model so that restore_model can return to it
+    without touching the ROM again. This must be called after preprocessing
+    and before any room is decoded or any message file is parsed. Every
+    file is read and decompressed here once; the buffers are immutable and
+    shared with the live objects, and rooms restored from them are decoded
+    again on first access.
+    '''
+    for mmo in MapMetaObject.every:
+        if mmo.is_room and mmo.is_decoded:
+            raise Exception(f'Room {mmo.warp_index:0>3x} was decoded before '
+                            f'the model snapshot.')
+    if set(MessagePointerObject.parsers) != {0}:
+        raise Exception('Message files were parsed before the model '
+                        'snapshot.')
+    for mmo in MapMetaObject.every:
+        if not mmo.is_rom_split:
+            mmo.get_compressed()
+            mmo.get_decompressed()
+
+    objects = {}
+    for cls in MODEL_TABLE_OBJECTS:
+        objects[cls] = [copy_state(o.__dict__) for o in cls.every]
+        for state in objects[cls]:
+            state.pop('_property_cache', None)
+    return {
+        'objects': objects,
+        'classes': {attribute: copy_state(getattr(MapMetaObject, attribute))
+                    for attribute in MODEL_CLASS_ATTRIBUTES},
+        'rooms': {mmo.warp_index: mmo.get_decompressed()
+                  for mmo in MapMetaObject.sorted_rooms},
+        'category_data': MapCategoryData.data.getvalue(),
+        'categories': {warp_index: copy_state(mcd.__dict__)
+                       for (warp_index, mcd)
+                       in MapCategoryData.datas_by_warp_index.items()},
+        }
+
+
+def restore_model(snapshot):
+    '''
+    Return the model to the state captured by snapshot_model. Derived
+    indexes are reset and rebuilt lazily. The output file is not touched,
+    so output for the next seed has to be written afresh.
+    '''
+    for cls, states in snapshot['objects'].items():
+        for o, state in zip(cls.every, states):
+            o.__dict__.clear()
+            o.__dict__.update(copy_state(state))
+            o.__dict__['_property_cache'] = {}
+    for attribute, value in snapshot['classes'].items():
+        setattr(MapMetaObject, attribute, copy_state(value))
+    MetaSizeObject.revision += 1
+
+    # BytesIO shares the initial bytes until the first write
+    MapCategoryData._data = BytesIO(snapshot['category_data'])
+    MapCategoryData._section_bases = None
+    for warp_index, state in snapshot['categories'].items():
+        mcd = MapCategoryData.datas_by_warp_index[warp_index]
+        mcd.__dict__.clear()
+        mcd.__dict__.update(copy_state(state))
+    for warp_index in (MapCategoryData.datas_by_warp_index.keys()
+                       - snapshot['categories'].keys()):
+        del(MapCategoryData.datas_by_warp_index[warp_index])
+
+    MessagePointerObject.parsers = {0: None}
+    MessagePointerObject._messages_by_file = None
+
+    # Signatures depend only on decoding order within a room, so rooms
+    # decoded again on demand get back the same signatures.
+    MapMetaObject.entity_signatures = SignatureRegistry()
+    MapMetaObject.indexed_definitions = DefinitionIndex()
+    MapMetaObject.invalidate_room_registry()
+    MapMetaObject.build_room_registry()
+    MapMetaObject._actor_catalog = None
+    MapMetaObject.all_rooms_decoded = False
+
+
+def verify_model(snapshot):
+    '''
+    Check that every room serializes to its vanilla data and that the misc
+    data and tables match the snapshot. This decodes every room.
+    '''
+    for cls, states in snapshot['objects'].items():
+        if cls is MapMetaObject:
+            continue
+        for o, state in zip(cls.every, states):
+            current = dict(o.__dict__)
+            current.pop('_property_cache', None)
+            if current != state:
+                raise Exception(f'{cls.__name__} {o.index:0>3x} does not '
+                                f'match its vanilla data.')
+    for mmo in MapMetaObject.sorted_rooms:
+        data, vanilla = mmo.data, snapshot['rooms'][mmo.warp_index]
+        length = max(len(data), len(vanilla))
+        if data.ljust(length, b'\x00') != vanilla.ljust(length, b'\x00'):
+            raise Exception(f'Room {mmo.warp_index:0>3x} does not match '
+                            f'its vanilla data.')
+        if mmo.data_has_changed:
+            raise Exception(f'Room {mmo.warp_index:0>3x} is marked changed.')
+    if MapCategoryData.data.getvalue() != snapshot['category_data']:
+        raise Exception(f'File {MapCategoryData.ROOM_DATA_INDEX:0>3x} does '
+                        f'not match its vanilla data.')
+    for warp_index, state in snapshot['categories'].items():
+        mcd = MapCategoryData.get_by_warp_index(warp_index)
+        for attribute in mcd.STRUCTURE:
+            if getattr(mcd, attribute) != state[attribute]:
+                raise Exception(f'Room {warp_index:0>3x} misc data '
+                                f'{attribute} does not match its vanilla '
+                                f'data.')
+        if mcd.has_changed:
+            raise Exception(f'Room {warp_index:0>3x} misc data is marked '
+                            f'changed.')
+
+
+def check_snapshot_restore():
+    '''
+    Change every room, its misc data, and its file size, then restore the
+    snapshot and check that the model is back to vanilla. The model is
+    restored once more afterwards, so rooms are left undecoded.
+    '''
+    snapshot = snapshot_model()
+    for mmo in MapMetaObject.sorted_rooms:
+        mmo.footer = bytes(reversed(mmo.footer)) + b'\xff'
+        mmo.metasize.metasize += 0x10
+        mcd = MapCategoryData.get_by_warp_index(mmo.warp_index)
+        mcd.bgm ^= 1
+        mcd.save_attributes()
+        assert mmo.data_has_changed
+    assert MapCategoryData.data.getvalue() != snapshot['category_data']
+    restore_model(snapshot)
+    verify_model(snapshot)
+    restore_model(snapshot)
+
+
+def decompress_file_data(data, is_compressed):
+    if not is_compressed:
+        return data
+    length = int.from_bytes(data[:4], byteorder='big')
+    return decompress(data[4:length])
+
+
+class RoomImage:
+    '''
+    A read-only decoding of a room file from an arbitrary ROM, which is
+    used to compare entities without touching the rooms being randomized.
+    '''
+    def __init__(self, warp_index, data, metadata):
+        self.warp_index = warp_index
+        self.definitions = []
+        self.spawn_groups = {}
+        self.created = []
+        try:
+            self.decode(data, metadata)
+        except:
+            self.release()
+            raise
+
+    def decode(self, data, metadata):
+        # Same layout as MapMetaObject.get_entities, but tolerant of
+        # truncated data, since the ROM being compared may be malformed.
+        data = memoryview(data)
+        instance_offset = metadata['instance_offset']
+        footer_offset = metadata['footer_offset']
+        ending_offset = metadata['ending_offset']
+        self.footer = bytes(data[footer_offset:ending_offset])
+
+        length = MapMetaObject.EntityDefinition.DATA_LENGTH
+        for a in range(0, instance_offset, length):
+            self.definitions.append(self.create(
+                MapMetaObject.EntityDefinition, data[a:a+length]))
+
+        group_offsets = {(-1, -1, -1): 0}
+        keys = list(product(range(self.groups_x), range(self.groups_z),
+                            range(self.groups_y)))
+        size = MapMetaObject.GROUP_STRUCT.size
+        group_data = data[ending_offset:ending_offset + (len(keys) * size)]
+        group_data = group_data[:len(group_data) - (len(group_data) % size)]
+        for key, (flag, offset) in zip(
+                keys, MapMetaObject.GROUP_STRUCT.iter_unpack(group_data)):
+            if flag == offset == 0:
+                continue
+            group_offsets[key] = offset - instance_offset
+
+        length = MapMetaObject.EntityInstance.DATA_LENGTH
+        instance_segment = data[instance_offset:footer_offset]
+        for key, offset in sorted(group_offsets.items()):
+            spawn_group = []
+            while offset + length <= len(instance_segment):
+                edata = instance_segment[offset:offset+length]
+                offset += length
+                if not any(edata):
+                    break
+                spawn_group.append(self.create(
+                    MapMetaObject.EntityInstance, edata))
+            if spawn_group:
+                self.spawn_groups[key] = spawn_group
+
+    @property
+    def groups_x(self):
+        return int.from_bytes(self.footer[0x14:0x16], byteorder='big')
+
+    @property
+    def groups_z(self):
+        return int.from_bytes(self.footer[0x16:0x18], byteorder='big')
+
+    @property
+    def groups_y(self):
+        return int.from_bytes(self.footer[0x18:0x1a], byteorder='big')
+
+    @property
+    def instances(self):
+        entities = []
+        for key in sorted(self.spawn_groups):
+            entities += self.spawn_groups[key]
+        return entities
+
+    @property
+    def entities(self):
+        return self.definitions + self.instances
+
+    def create(self, entity_class, data):
+        # Track entities as they are made so that release can unregister
+        # their labels even if decoding fails partway through.
+        entity = entity_class(data, self, index=len(self.created),
+                              validate=False, check_index=False)
+        self.created.append(entity)
+        return entity
+
+    def mark_changed(self):
+        return
+
+    def release(self):
+        while self.created:
+            MapMetaObject.entity_signatures.unregister(self.created.pop())
+
+    def diff(self, other):
+        lines = []
+        num_definitions = max(len(self.definitions), len(other.definitions))
+        for index in range(num_definitions):
+            a = self.definitions[index:index+1]
+            b = other.definitions[index:index+1]
+            if [e.data for e in a] == [e.data for e in b]:
+                continue
+            lines.append(f'DEFINITION {index:0>3x}')
+            lines += [f'- {e}'.replace('\n', '\n-   ') for e in a]
+            lines += [f'+ {e}'.replace('\n', '\n+   ') for e in b]
+
+        for key in sorted(self.spawn_groups.keys() | other.spawn_groups.keys()):
+            a = self.spawn_groups.get(key, [])
+            b = other.spawn_groups.get(key, [])
+            label = ','.join([f'{g:0>2x}' for g in key])
+            for index in range(max(len(a), len(b))):
+                ai, bi = a[index:index+1], b[index:index+1]
+                if [e.data for e in ai] == [e.data for e in bi]:
+                    continue
+                lines.append(f'INSTANCE {label} +{index:0>2x}')
+                lines += [f'- {e}'.replace('\n', '\n-   ') for e in ai]
+                lines += [f'+ {e}'.replace('\n', '\n+   ') for e in bi]
+
+        if self.footer != other.footer:
+            lines.append('FOOTER')
+            lines.append(f'- {pretty_hexify(self.footer, newlines=False)}')
+            lines.append(f'+ {pretty_hexify(other.footer, newlines=False)}')
+        return lines
+
+
+def diff_roms(filename_a, filename_b):
+    print(f'Comparing {filename_a} to {filename_b}...')
+    pointers_a, compressed_a = MapMetaObject.read_pointer_table(filename_a)
+    pointers_b, compressed_b = MapMetaObject.read_pointer_table(filename_b)
+
+    main_code = MapMetaObject.get_by_file_index(
+            MapMetaObject.MAIN_CODE_FILE_INDEX)
+    differing = []
+    for mmo in MapMetaObject.every:
+        if mmo.is_rom_split:
+            continue
+        if compressed_a[mmo.index] != compressed_b[mmo.index]:
+            differing.append(mmo.index)
+    # Main code is needed for room metadata even if it does not differ
+    to_decompress = set(differing)
+    if any(MapMetaObject.get(index).is_room for index in differing):
+        to_decompress.add(main_code.index)
+    to_decompress = sorted(to_decompress)
+
+    jobs = []
+    for pointers, compressed in [(pointers_a, compressed_a),
+                                 (pointers_b, compressed_b)]:
+        jobs += [(compressed[index], bool(pointers[index] & 0x80000000))
+                 for index in to_decompress]
+    with Pool() as pool:
+        decompressed = pool.starmap(decompress_file_data, jobs)
+    decompressed_a = dict(zip(to_decompress,
+                              decompressed[:len(to_decompress)]))
+    decompressed_b = dict(zip(to_decompress,
+                              decompressed[len(to_decompress):]))
+
+    metadata_a, metadata_b = {}, {}
+    if main_code.index in to_decompress:
+        for (metadata, decompressed) in [(metadata_a, decompressed_a),
+                                         (metadata_b, decompressed_b)]:
+            room_metadata = MapMetaObject.read_room_metadata(
+                    decompressed[main_code.index])
+            for warp_index, values in room_metadata.items():
+                values['warp_index'] = warp_index
+                metadata[values['actor_file_index']] = values
+
+    s = ''
+    for index in differing:
+        mmo = MapMetaObject.get(index)
+        a, b = decompressed_a[index], decompressed_b[index]
+        header = f'FILE {mmo.file_index:0>3x}'
+        if mmo.is_room:
+            header = f'{header}  # ROOM {mmo.warp_index:0>3X}'
+            if mmo.room_name:
+                header = f'{header} {mmo.room_name}'
+        if a == b:
+            s += f'{header}\n  Compressed data differs only.\n\n'
+            continue
+        differences = sum(1 for (x, y) in zip(a, b) if x != y)
+        differences += abs(len(a) - len(b))
+        first = min([n for (n, (x, y)) in enumerate(zip(a, b)) if x != y]
+                    + [min(len(a), len(b))])
+        s += (f'{header}\n  Length {len(a):x} -> {len(b):x}, '
+              f'{differences:x} bytes differ starting at {first:x}.\n')
+        if (mmo.is_room and mmo.file_index in metadata_a
+                and mmo.file_index in metadata_b):
+            room_a = RoomImage(metadata_a[mmo.file_index]['warp_index'], a,
+                               metadata_a[mmo.file_index])
+            try:
+                room_b = RoomImage(metadata_b[mmo.file_index]['warp_index'],
+                                   b, metadata_b[mmo.file_index])
+                try:
+                    lines = room_a.diff(room_b)
+                finally:
+                    room_b.release()
+            finally:
+                room_a.release()
+            if lines:
+                s += '  ' + '\n'.join(lines).replace('\n', '\n  ') + '\n'
+        s += '\n'
+    s = s.strip()
+    if not s:
+        s = 'No differences found.'
+
+    if 'MN64_DIFF_EXPORT' in environ:
+        diff_filename = environ['MN64_DIFF_EXPORT']
+    else:
+        diff_filename = f'{get_outfile()}.diff.txt'
+    print(f'EXPORTING differences to {diff_filename}')
+    with open(diff_filename, mode='w+', encoding='utf8') as f:
+        f.write(s)
 
 
 def export_data():
@@ -3983,14 +5190,11 @@ def export_data():
 def get_pretty_message_dump():
     result = ''
     printed = set()
-    file_indexes = {mpo.file_index for mpo in MessagePointerObject.every}
     divider = '-'*79
     result = divider + '\n'
-    for index in sorted(file_indexes):
+    for index, mpos in sorted(MessagePointerObject.messages_by_file.items()):
         if index == 0:
             continue
-        mpos = [mpo for mpo in MessagePointerObject.every
-                if mpo.file_index == index]
         for mpo in mpos:
             if mpo.scripts:
                 s, did_scripts = MessagePointerObject.get_pretty_script(
@@ -4102,6 +5306,7 @@ if __name__ == '__main__':
             'norandom': ['norandom'],
             'enemizer': ['enemizer'],
             'debugmenu': ['debugmenu'],
+            'diff': ['diff'],
         }
 
         run_interface(ALL_OBJECTS, snes=False, n64=True, codes=codes,
@@ -4109,6 +5314,9 @@ if __name__ == '__main__':
         for code in sorted(get_activated_codes()):
             print('Code "%s" activated.' % code)
 
+        if DEBUG_MODE:
+            check_snapshot_restore()
+
         import_filename = None
         script_filename = None
         if 'import' in get_activated_codes():
@@ -4137,6 +5345,13 @@ if __name__ == '__main__':
             except FileNotFoundError:
                 print(f'Failed to import script from "{script_filename}"')
 
+        if 'diff' in get_activated_codes():
+            if 'MN64_DIFF' in environ:
+                diff_filename = environ['MN64_DIFF']
+            else:
+                diff_filename = input('Compare against ROM filename: ')
+            diff_roms(get_outfile(), diff_filename.strip())
+
         if 'norandom' not in get_activated_codes():
             randomize_doors()
         else:
@@ -4175,6 +5390,16 @@ if __name__ == '__main__':
                 print('No modifications made; generating clean export.')
                 export_data()
             clean_and_write(ALL_OBJECTS)
+            if 'export' not in get_activated_codes():
+                # Nothing here reads entities, so rooms should stay encoded
+                decoded = [mmo for mmo in MapMetaObject.sorted_rooms
+                           if mmo.is_decoded]
+                assert not decoded, (f'{len(decoded)} rooms were decoded '
+                                     f'in an unmodified run.')
+
+        if DEBUG_MODE:
+            print(MapMetaObject.budget_report())
+            print(MapMetaObject.memory_report())
 
         checksum(get_open_file(get_outfile()))
         finish_interface()